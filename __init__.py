@@ -7,9 +7,22 @@ from . import stock
 def register():
     Pool.register(
         stock.PrintStockMoveLocationStart,
+        stock.Location,
+        stock.StockMoveLocationLedger,
+        stock.StockMoveLocationLedgerState,
+        stock.PrintStockMoveLocationExecution,
+        stock.StockMoveLocationCheckpoint,
+        stock.Move,
         module='stock_move_location_report', type_='model')
+    Pool.register(
+        stock.StockMoveLocationLedgerLot,
+        stock.StockMoveLocationCheckpointLot,
+        stock.MoveLot,
+        module='stock_move_location_report', type_='model',
+        depends=['stock_lot'])
     Pool.register(
         stock.PrintStockMoveLocation,
+        stock.RebuildStockMoveLocationLedger,
         module='stock_move_location_report', type_='wizard')
     Pool.register(
         stock.PrintStockMoveLocationReport,
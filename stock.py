@@ -1,18 +1,203 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
-from trytond.model import fields, ModelView
-from trytond.pool import Pool
+import csv
+import io
+import json
+import logging
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from datetime import datetime, timedelta
+from html import escape
+from itertools import chain, groupby, islice
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import quote
+from xml.sax.saxutils import escape as xml_escape
+from trytond import backend
+from trytond.model import (fields, Exclude, Index, ModelSingleton, ModelSQL,
+    ModelView)
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval, If
-from trytond.wizard import Wizard, StateView, StateReport, Button
-from trytond.transaction import Transaction
+from trytond.wizard import (Wizard, StateView, StateReport, StateTransition,
+    Button)
+from trytond.transaction import Transaction, without_check_access
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.i18n import gettext
 from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.html_report.engine import DualRecord, render as html_render
 from trytond.url import http_host
+from trytond.protocols.jsonrpc import JSONEncoder
 from trytond.modules.html_report.i18n import _
-from dominate.util import raw
-from dominate.tags import (a, button, div, h1, i, script, strong, table, tbody,
-    td, th, thead, tr)
+from sql import Column, Conflict, Literal, Null, Select, Table, Window
+from sql.operators import Equal, Exists, Or
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, DateTrunc
+from dominate.util import container, raw
+from dominate.tags import (a, button, div, h1, h3, i, script, span, strong,
+    table, tbody, td, th, thead, tr)
+
+logger = logging.getLogger(__name__)
+
+_LINK = '<a href="{}">{}</a>'
+_ARROW = '<i class="fas fa-arrow-right"></i>'
+# The exports are written to the disk beyond this size
+_SPOOL_SIZE = 1024 * 1024
+
+
+class Bucket(NamedTuple):
+    """A kind of move of the report
+
+    The from and to locations of the moves are matched by `'warehouse'` for
+    the locations of the warehouse, `'outside'` for the other locations not
+    of a type of a registered bucket, or the type of the location. The sign
+    is the direction in which the quantities change the stock of the
+    warehouse and draw returns the detail table of the moves from the key,
+    the rows and the parameters of the report. An optional bucket is only
+    classified when it is requested by the report.
+    """
+    name: str
+    title: str
+    from_: str
+    to: str
+    sign: int
+    draw: Callable
+    section: Optional[str] = None
+    optional: bool = False
+
+
+class _CountingCursor:
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._counter.rows += 1
+            yield row
+
+    def execute(self, *args, **kwargs):
+        self._counter.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._counter.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._counter.rows += len(rows)
+        return rows
+
+
+class _CountingConnection:
+    "Count the statements executed and rows fetched on the connection"
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.statements = 0
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self, self._connection.cursor(*args, **kwargs))
+
+
+class _Diagnostics:
+    "Collect the wall time, SQL statements and rows fetched of the report"
+
+    def __init__(self):
+        self.phases = defaultdict(
+            lambda: dict.fromkeys(['calls', 'time', 'statements', 'rows'], 0))
+        self.chunks = []
+        self.buckets = defaultdict(int)
+        self.keys = defaultdict(int)
+        self.cache_hits = 0
+        self.plans = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, phase, **chunk):
+        "Measure the block as a phase and as a chunk if chunk is not empty"
+        transaction = Transaction()
+        connection = transaction.connection
+        counter = transaction.connection = _CountingConnection(connection)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            transaction.connection = connection
+            values = {
+                'time': time.perf_counter() - start,
+                'statements': counter.statements,
+                'rows': counter.rows,
+                }
+            # Chunks may be measured at the same time by the workers
+            with self._lock:
+                phase_values = self.phases[phase]
+                phase_values['calls'] += 1
+                for name, value in values.items():
+                    phase_values[name] += value
+                if chunk:
+                    self.chunks.append(dict(chunk, **values))
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def add_moves(self, key, warehouse, bucket, count):
+        with self._lock:
+            self.buckets[bucket] += count
+            self.keys['%s,%s,%s' % (key + (warehouse,))] += count
+
+    def as_dict(self):
+        return {
+            'phases': dict(self.phases),
+            'chunks': self.chunks,
+            'buckets': dict(self.buckets),
+            'keys': dict(self.keys),
+            'cache_hits': self.cache_hits,
+            'plans': self.plans,
+            }
+
+    def log(self):
+        for phase, values in self.phases.items():
+            logger.info('%s: %s calls, %.3fs, %s statements, %s rows',
+                phase, values['calls'], values['time'], values['statements'],
+                values['rows'])
+        logger.info('cache hits: %s', self.cache_hits)
+        for phase, plan in self.plans.items():
+            if plan is not None:
+                logger.info('%s query uses the index of the moves: %s',
+                    phase, plan['index_used'])
+                logger.debug('%s query plan:\n%s', phase,
+                    '\n'.join(plan['plan']))
+        for bucket, count in self.buckets.items():
+            logger.info('bucket %s: %s moves', bucket, count)
+        for chunk in self.chunks:
+            logger.debug('chunk of %s keys: %.3fs, %s statements, %s rows',
+                chunk['keys'], chunk['time'], chunk['statements'],
+                chunk['rows'])
+        for key, count in self.keys.items():
+            logger.debug('key %s: %s moves', key, count)
 
 
 class PrintStockMoveLocationStart(ModelView):
@@ -32,15 +217,55 @@ class PrintStockMoveLocationStart(ModelView):
         states={
             'required': Bool(Eval('from_date', False)),
         })
-    warehouse = fields.Many2One('stock.location', 'Warehouse',
-        required=True, domain=[('type', '=', 'warehouse')])
+    warehouses = fields.Many2Many('stock.location', None, None,
+        'Warehouses', required=True, domain=[('type', '=', 'warehouse')])
+    totals_only = fields.Boolean('Totals Only',
+        help='Show only the totals of each movement type without the detail '
+        'of the moves.')
+    by_lot = fields.Boolean('Break Down by Lot',
+        help='Show a section for each lot of the products.\n'
+        'It is only used when printing products.')
+    period = fields.Selection([
+            (None, ''),
+            ('day', 'Daily'),
+            ('week', 'Weekly'),
+            ('month', 'Monthly'),
+            ], 'Period',
+        help='Show the quantities of each kind of move and the balance of '
+        'the stock by period.')
+    link_details = fields.Boolean('Link Details',
+        states={
+            'invisible': Bool(Eval('totals_only')),
+            },
+        help='Link the totals to the list of their moves instead of including '
+        'the detail of the moves in the report.')
+    internal_transfers = fields.Boolean('Internal Transfers',
+        help='Show the moves between the locations of the warehouse.')
+    reconcile = fields.Boolean('Reconcile Stock',
+        help='Compare the final stock of each product with the stock of the '
+        'warehouse at the end date and flag the differences.')
+    background = fields.Boolean('In Background',
+        help='Generate the report in a background task and notify when it is '
+        'ready in the Stock Move Location Executions.')
+    output_format = fields.Selection([
+            ('html', 'HTML'),
+            ('csv', 'CSV'),
+            ('jsonl', 'JSON Lines'),
+            ('ods', 'OpenDocument Spreadsheet'),
+            ], 'Format', required=True,
+        help='The HTML format is the printable report while the other formats '
+        'export one line per total and per move for other tools.')
 
     @classmethod
-    def default_warehouse(cls):
+    def default_warehouses(cls):
         Location = Pool().get('stock.location')
-        locations = Location.search(cls.warehouse.domain)
+        locations = Location.search(cls.warehouses.domain)
         if len(locations) == 1:
-            return locations[0].id
+            return [locations[0].id]
+
+    @staticmethod
+    def default_output_format():
+        return 'html'
 
 
 class PrintStockMoveLocation(Wizard):
@@ -49,16 +274,38 @@ class PrintStockMoveLocation(Wizard):
     start = StateView('stock.move.location.start',
         'stock_move_location_report.print_stock_move_location_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Print', 'print_', 'tryton-print', default=True),
+            Button('Print', 'run', 'tryton-print', default=True),
             ])
+    run = StateTransition()
     print_ = StateReport('stock.move.location.report')
 
+    def transition_run(self):
+        pool = Pool()
+        Execution = pool.get('stock.move.location.report.execution')
+        if not self.start.background:
+            return 'print_'
+        _, data = self.do_print_(None)
+        execution = Execution(data=data)
+        execution.save()
+        with Transaction().set_context(
+                queue_name='stock_move_location_report'):
+            Execution.__queue__.generate([execution])
+        return 'end'
+
     def do_print_(self, action):
         context = Transaction().context
         data = {
             'from_date': self.start.from_date,
             'to_date': self.start.to_date,
-            'warehouse': self.start.warehouse.id,
+            'warehouses': [w.id for w in self.start.warehouses],
+            'totals_only': self.start.totals_only,
+            'link_details': self.start.link_details,
+            'by_lot': self.start.by_lot,
+            'period': self.start.period,
+            'reconcile': self.start.reconcile,
+            'optional_buckets': (['internal_transfers']
+                if self.start.internal_transfers else []),
+            'output_format': self.start.output_format,
             'model': context.get('active_model'),
             'ids': context.get('active_ids'),
             }
@@ -67,6 +314,10 @@ class PrintStockMoveLocation(Wizard):
 
 class PrintStockMoveLocationReport(DominateReport):
     __name__ = 'stock.move.location.report'
+    _prepare_cache = Cache('stock.move.location.report.prepare',
+        context=False)
+    _locations_cache = Cache('stock.move.location.report.locations',
+        context=False)
 
     @classmethod
     def prepare(cls, data):
@@ -76,6 +327,9 @@ class PrintStockMoveLocationReport(DominateReport):
         Move = pool.get('stock.move')
         Location = pool.get('stock.location')
         Company = pool.get('company.company')
+        Ledger = pool.get('stock.move.location.ledger')
+        Checkpoint = pool.get('stock.move.location.checkpoint')
+        Date = pool.get('ir.date')
 
         try:
             Production = pool.get('production')
@@ -87,37 +341,46 @@ class PrintStockMoveLocationReport(DominateReport):
             Lot = None
 
         move = Move.__table__()
-        cursor = Transaction().connection.cursor()
 
         t_context = Transaction().context
         company_id = t_context.get('company')
         from_date = data.get('from_date') or datetime.min.date()
         to_date = data.get('to_date') or datetime.max.date()
-        warehouse = Location(data.get('warehouse'))
+        warehouses = Location.browse(data.get('warehouses')
+            or [data['warehouse']])
+        warehouse_ids = [w.id for w in warehouses]
 
         parameters = {}
         parameters['from_date'] = from_date
         parameters['to_date'] = to_date
-        parameters['warehouse'] = warehouse.rec_name
+        parameters['warehouses'] = [w.rec_name for w in warehouses]
         parameters['show_date'] = True if data.get('from_date') else False
         parameters['production'] = True if Production else False
         parameters['lot'] = True if Lot else False
+        parameters['totals_only'] = bool(data.get('totals_only'))
+        parameters['period'] = data.get('period')
+        parameters['reconcile'] = bool(data.get('reconcile'))
+        parameters['link_details'] = (not parameters['totals_only']
+            and bool(data.get('link_details')))
+        # The moves are only read when they are included in the report
+        with_moves = not (parameters['totals_only']
+            or parameters['link_details'])
         parameters['base_url'] = '%s/#%s' % (http_host(),
             Transaction().database.name)
         parameters['company'] = (DualRecord(Company(company_id))
             if company_id is not None and company_id >= 0 else None)
+        diagnostics = _Diagnostics() if cls._diagnostics_enabled() else None
+        parameters['diagnostics'] = diagnostics
+
+        def measure(phase, **chunk):
+            if diagnostics is None:
+                return nullcontext()
+            return diagnostics.measure(phase, **chunk)
 
-        # Locations
-        locations = [l.id for l in Location.search([
-            ('parent', 'child_of', [warehouse.id])])]
-        location_suppliers = [l.id for l in Location.search(
-            [('type', '=', 'supplier')])]
-        location_customers = [l.id for l in Location.search([
-            ('type', '=', 'customer')])]
-        location_lost_founds = [l.id for l in Location.search([
-            ('type', '=', 'lost_found')])]
-        location_productions = [l.id for l in Location.search([
-            ('type', '=', 'production')])] if Production else []
+        def explain(phase, query):
+            # Only the plan of the first chunk is kept
+            if diagnostics is not None and phase not in diagnostics.plans:
+                diagnostics.plans[phase] = cls._explain(query)
 
         keys = ()
         if data.get('model') == 'product.template':
@@ -134,155 +397,908 @@ class PrintStockMoveLocationReport(DominateReport):
             Lot = pool.get('stock.lot')
             for lot in Lot.browse(data['ids']):
                 keys += ((lot.product, lot),)
+        # The lots of the products are found by the same queries grouped by
+        # the lot of the moves
+        lot_breakdown = bool(Lot and data.get('by_lot')
+            and grouping == ('product',))
+        if lot_breakdown:
+            grouping = ('product', 'lot')
+        parameters['by_lot'] = lot_breakdown
+
+        parameters['count'] = len(keys)
+
+        # Each move is classified against every warehouse in the same scan
+        bucket_names = cls._get_bucket_names()
+        optional = data.get('optional_buckets') or []
+        buckets = []
+        conditions = []
+        active = set()
+        for warehouse in warehouses:
+            with measure('locations'):
+                locations = cls._get_locations(warehouse)
+            if parameters['link_details']:
+                parameters.setdefault('detail_domains', {})[warehouse.id] = (
+                    cls._get_detail_domains(warehouse, locations, data))
+            bucket, where = cls._classify(move, locations, optional)
+            buckets.append(bucket)
+            conditions.append(where)
+            active.update(b.name
+                for b in cls._get_active_buckets(locations, optional))
+        # The buckets of any of the warehouses are shown for all of them
+        parameters['buckets'] = [n for n in bucket_names if n in active]
+
+        sql_common_where = ((move.state == 'done')
+            & (move.company == company_id)
+            & Or(conditions))
+        if data.get('from_date'):
+            sql_common_where &= (move.effective_date >= from_date)
+        if data.get('to_date'):
+            sql_common_where &= (move.effective_date <= to_date)
+        lot_grouping = 'lot' in grouping
+        lot_filter = lot_grouping and not lot_breakdown
+
+        def key_columns(table):
+            columns = [table.product]
+            if lot_grouping:
+                columns.append(table.lot)
+            return columns
+
+        def bucket_columns(table=None):
+            if table is None:
+                return [b.as_('bucket_%s' % i) for i, b in enumerate(buckets)]
+            return [getattr(table, 'bucket_%s' % i)
+                for i in range(len(buckets))]
+
+        def split_row(row):
+            "Return the key, the other values and the warehouse buckets"
+            product_id = row[0]
+            lot_id = row[1] if lot_grouping else None
+            values = row[2:] if lot_grouping else row[1:]
+            return ((product_id, lot_id), values[:-len(buckets)],
+                zip(warehouse_ids, values[-len(buckets):]))
+
+        def default_uom(product_id, uoms):
+            "Return the default unit of the product in the transaction"
+            Uom = pool.get('product.uom')
+            uom_id = default_uoms[product_id]
+            if uom_id not in uoms:
+                uoms[uom_id] = Uom(uom_id)
+            return uoms[uom_id]
 
         def compute_quantites(sql_where):
-            Uom = Pool().get('product.uom')
+            Uom = pool.get('product.uom')
+            cursor = Transaction().connection.cursor()
+            uoms = {}
 
-            query = move.select(move.id.as_('move_id'), where=sql_where,
+            classified = move.select(*key_columns(move), move.unit,
+                move.quantity, *bucket_columns(), where=sql_where)
+            columns = (key_columns(classified) + [classified.unit]
+                + bucket_columns(classified))
+            query = classified.select(*columns[:-len(buckets)],
+                Sum(classified.quantity).as_('quantity'),
+                *columns[-len(buckets):],
+                group_by=columns)
+            explain('quantities', query)
+            cursor.execute(*query)
+            result = defaultdict(int)
+            for row in cursor:
+                key_id, (unit_id, quantity), warehouse_buckets = (
+                    split_row(row))
+                if unit_id not in uoms:
+                    uoms[unit_id] = Uom(unit_id)
+                # One conversion per unit instead of one per move
+                quantity = Uom.compute_qty(uoms[unit_id], quantity,
+                    default_uom(key_id[0], uoms), True)
+                for warehouse_id, bucket_name in warehouse_buckets:
+                    if bucket_name:
+                        result[key_id, warehouse_id, bucket_name] += quantity
+            return result
+
+        def compute_ledger_quantities(product_ids, lot_ids):
+            ledger = Ledger.__table__()
+            cursor = Transaction().connection.cursor()
+            uoms = {}
+            where = ((ledger.company == company_id)
+                & ledger.warehouse.in_(warehouse_ids)
+                & reduce_ids(ledger.product, product_ids)
+                & ledger.bucket.in_(parameters['buckets']))
+            if lot_filter:
+                where &= reduce_ids(ledger.lot, lot_ids)
+            if data.get('from_date'):
+                where &= (ledger.date >= from_date)
+            if data.get('to_date'):
+                where &= (ledger.date <= to_date)
+            columns = key_columns(ledger) + [ledger.warehouse, ledger.bucket]
+            query = ledger.select(*columns,
+                Sum(ledger.quantity).as_('quantity'),
+                where=where, group_by=columns)
+            cursor.execute(*query)
+            result = {}
+            for row in cursor:
+                product_id = row[0]
+                lot_id = row[1] if lot_grouping else None
+                warehouse_id, bucket_name, quantity = row[-3:]
+                result[(product_id, lot_id), warehouse_id, bucket_name] = (
+                    default_uom(product_id, uoms).round(quantity))
+            return result
+
+        def compute_periods(sql_where):
+            "Return the quantities and running balance of each period"
+            Template = pool.get('product.template')
+            Uom = pool.get('product.uom')
+            product = Product.__table__()
+            template = Template.__table__()
+            from_uom = Uom.__table__()
+            to_uom = Uom.__table__()
+            cursor = Transaction().connection.cursor()
+            outgoing = cls._get_outgoing_bucket_names()
+            unsigned = [b.name for b in cls._get_bucket_registry()
+                if not b.sign]
+            uoms = {}
+
+            # The quantities are converted in the default unit of the product
+            # so the balance is summed by the database
+            join = (move
+                .join(product, condition=move.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .join(from_uom, condition=move.unit == from_uom.id)
+                .join(to_uom, condition=template.default_uom == to_uom.id))
+            result = defaultdict(dict)
+            for warehouse_id, bucket in zip(warehouse_ids, buckets):
+                classified = join.select(*key_columns(move),
+                    DateTrunc(parameters['period'], move.effective_date
+                        ).as_('period'),
+                    (move.quantity * from_uom.factor / to_uom.factor
+                        ).as_('quantity'),
+                    bucket.as_('bucket'),
+                    where=sql_where)
+                columns = key_columns(classified) + [
+                    classified.period, classified.bucket]
+                grouped = classified.select(*columns,
+                    Sum(classified.quantity).as_('quantity'),
+                    where=classified.bucket != Null,
+                    group_by=columns)
+                signed = Case(*chain(
+                        ((grouped.bucket == name, -grouped.quantity)
+                            for name in outgoing),
+                        ((grouped.bucket == name, Literal(0))
+                            for name in unsigned)),
+                    else_=grouped.quantity)
+                # The default frame includes all the buckets of the period
+                query = grouped.select(*key_columns(grouped),
+                    grouped.period, grouped.bucket, grouped.quantity,
+                    Sum(signed, window=Window(key_columns(grouped),
+                            order_by=[grouped.period])),
+                    order_by=key_columns(grouped) + [grouped.period])
+                explain('periods', query)
+                cursor.execute(*query)
+                for row in cursor:
+                    product_id = row[0]
+                    lot_id = row[1] if lot_grouping else None
+                    period, bucket_name, quantity, balance = row[-4:]
+                    # The conversions of the database are not rounded
+                    uom = default_uom(product_id, uoms)
+                    quantity, balance = uom.round(quantity), uom.round(balance)
+                    if isinstance(period, str):
+                        period = datetime.fromisoformat(period)
+                    if isinstance(period, datetime):
+                        period = period.date()
+                    values = result[(product_id, lot_id), warehouse_id
+                        ].setdefault(period, {'balance': balance})
+                    values[bucket_name] = (
+                        -quantity if bucket_name in outgoing else quantity)
+            return dict(result)
+
+        def compute_moves(sql_where):
+            cursor = Transaction().connection.cursor()
+            query = move.select(*key_columns(move), move.id,
+                *bucket_columns(), where=sql_where,
                 order_by=move.effective_date.desc)
+            explain('moves', query)
             cursor.execute(*query)
-            move_ids = [m[0] for m in cursor.fetchall()]
-            moves = Move.browse(move_ids)
-            total = sum([Uom.compute_qty(
-                            m.unit, m.quantity, m.product.default_uom, True)
-                            for m in moves])
-            moves = [DualRecord(m) for m in moves]
-            return total, moves
-
-        records = []
-        for key in keys:
-            product = key[0]
-            lot = key[1]
-
-            # Initial stock
+            result = defaultdict(list)
+            for row in cursor:
+                key_id, (move_id,), warehouse_buckets = split_row(row)
+                for warehouse_id, bucket_name in warehouse_buckets:
+                    if bucket_name in bucket_names:
+                        result[key_id, warehouse_id, bucket_name].append(
+                            move_id)
+            return dict(result)
+
+        def compute_watermark(key_where):
+            # Any move done or modified for the keys changes the watermark
+            cursor = Transaction().connection.cursor()
+            query = move.select(
+                Max(Coalesce(move.write_date, move.create_date)),
+                Count(move.id),
+                where=key_where & (move.state == 'done')
+                & (move.company == company_id))
+            cursor.execute(*query)
+            return cursor.fetchone()
+
+        default_uoms = {product.id: product.default_uom.id
+            for product, lot in keys}
+
+        def compute_stock(product_ids, lot_ids, date):
+            "Return the stock of the keys in the warehouses at the date"
+            grouping_filter = (product_ids,)
+            if lot_filter:
+                grouping_filter += (lot_ids,)
+            # The stock is computed from the cache of the latest closed
+            # period before the date, so only the moves done after that
+            # period are aggregated
             context = {}
-            context['stock_date_end'] = from_date
+            context['stock_date_end'] = date
             with Transaction().set_context(context):
-                pbl = Product.products_by_location([warehouse.id],
+                return Product.products_by_location(warehouse_ids,
                     with_childs=True,
-                    grouping_filter=([product.id],),
+                    grouping_filter=grouping_filter,
                     grouping=grouping)
-            key = ((warehouse.id, product.id, lot.id)
-                if lot else (warehouse.id, product.id))
-            initial_stock = pbl.get(key, 0)
-
-            sql_common_where = ((move.product == product.id)
-                & (move.effective_date >= from_date)
-                    & (move.effective_date <= to_date)
-                & (move.state == 'done') & (move.company == company_id))
-            if lot:
-                sql_common_where &= (move.lot == lot.id)
-
-            # supplier_incommings from_location = supplier
-            sql_where = (sql_common_where
-                & (move.from_location.in_(location_suppliers))
-                & (move.to_location.in_(locations)))
-            supplier_incommings_total, supplier_incommings = compute_quantites(sql_where)
-
-            # supplier_returns: to_location = supplier
-            sql_where = (sql_common_where
-                & (move.to_location.in_(location_suppliers))
-                & (move.from_location.in_(locations)))
-            supplier_returns_total, supplier_returns = compute_quantites(sql_where)
-
-            # customer_outgoing: to_location = customer
-            sql_where = (sql_common_where
-                & (move.to_location.in_(location_customers))
-                & (move.from_location.in_(locations)))
-            customer_outgoings_total, customer_outgoings = compute_quantites(sql_where)
-
-            # customer_return: from_location = customer
-            sql_where = (sql_common_where
-                & (move.from_location.in_(location_customers))
-                & (move.to_location.in_(locations)))
-            customer_returns_total, customer_returns = compute_quantites(sql_where)
-
-            production_outs_total = 0
-            production_ins_total = 0
-            if location_productions:
-                # production_outs: to_location = production
-                sql_where = (sql_common_where
-                    & (move.from_location.in_(location_productions))
-                    & (move.to_location.in_(locations)))
-                production_outs_total, production_outs = compute_quantites(sql_where)
-
-                # production_ins: from_location = production
-                sql_where = (sql_common_where
-                    & (move.to_location.in_(location_productions))
-                    & (move.from_location.in_(locations)))
-                production_ins_total, production_ins = compute_quantites(sql_where)
-
-            # inventory
-            sql_where = (sql_common_where
-                & (move.from_location.in_(location_lost_founds))
-                & (move.to_location.in_(locations)))
-            lost_found_from_total, lost_found_from = compute_quantites(sql_where)
-
-            sql_where = (sql_common_where
-                & (move.to_location.in_(location_lost_founds))
-                & (move.from_location.in_(locations)))
-            lost_found_to_total, lost_found_to = compute_quantites(sql_where)
-
-            # Entries from outside warehouse
-            locations_in_out = (locations + location_lost_founds
-                + location_suppliers + location_customers)
-            if location_productions:
-                locations_in_out += location_productions
-
-            sql_where = (sql_common_where
-                & (~move.from_location.in_(locations_in_out))
-                & (move.to_location.in_(locations)))
-            in_to_total, in_to = compute_quantites(sql_where)
-
-            # Outputs from our warehouse
-            sql_where = (sql_common_where
-                & (move.from_location.in_(locations))
-                & (~move.to_location.in_(locations_in_out)))
-            out_to_total, out_to = compute_quantites(sql_where)
-
-            records.append({
-                'product': DualRecord(product),
-                'lot': DualRecord(lot),
-                'initial_stock': initial_stock,
-                'supplier_incommings_total': supplier_incommings_total,
-                'supplier_incommings': supplier_incommings,
-                'supplier_returns_total': (-supplier_returns_total
-                    if supplier_returns_total else 0),
-                'supplier_returns': supplier_returns,
-                'customer_outgoings_total': (
-                    -customer_outgoings_total if customer_outgoings_total else 0),
-                'customer_outgoings': customer_outgoings,
-                'customer_returns_total': customer_returns_total,
-                'customer_returns': customer_returns,
-                'production_outs_total': (production_outs_total
-                    if Production else 0),
-                'production_outs': production_outs if Production else 0,
-                'production_ins_total': (-production_ins_total
-                    if Production else 0),
-                'production_ins': production_ins if Production else 0,
-                'lost_found_total':
-                    lost_found_from_total - lost_found_to_total,
-                'lost_found_from_total': lost_found_from_total,
-                'lost_found_from': lost_found_from,
-                'lost_found_to_total': (-lost_found_to_total
-                    if lost_found_to_total else 0),
-                'lost_found_to': lost_found_to,
-                'in_to_total': in_to_total if in_to_total else 0,
-                'in_to': in_to,
-                'out_to_total': -out_to_total if out_to_total else 0,
-                'out_to': out_to,
-                'total': (initial_stock + supplier_incommings_total
-                    + (-supplier_returns_total) + (-customer_outgoings_total)
-                    + customer_returns_total + production_outs_total
-                    + (-production_ins_total) + (lost_found_from_total - lost_found_to_total)
-                    + in_to_total + (-out_to_total)),
-                })
-        return records, parameters
+
+        def compute_initial_stock(product_ids, lot_ids):
+            # There is no stock before the first move
+            if not data.get('from_date'):
+                return {}
+            return compute_stock(product_ids, lot_ids,
+                from_date - timedelta(days=1))
+
+        def compute_final_stock(product_ids, lot_ids):
+            # The stock after today includes the planned moves
+            return compute_stock(product_ids, lot_ids,
+                min(to_date, Date.today()))
+
+        def keys_where(key_ids):
+            where = reduce_ids(move.product,
+                list({product_id for product_id, lot_id in key_ids}))
+            if lot_filter:
+                where &= reduce_ids(move.lot,
+                    list({lot_id for product_id, lot_id in key_ids}))
+            return where
+
+        # The ledger is only read once it has been built with the current
+        # locations
+        use_ledger = Ledger.enabled()
+        if not use_ledger and Ledger.configured():
+            logger.warning('The stock move location ledger is not used '
+                'until it is rebuilt')
+        use_checkpoint = (not use_ledger and Checkpoint.enabled()
+            and not lot_breakdown)
+
+        # The totals are only stored for a range of closed days as the moves
+        # of today can still be done
+        checkpoint_date = (to_date
+            if data.get('to_date') and to_date < Date.today() else None)
+
+        def compute_changed(key_ids, date, stamp):
+            "Return the keys with moves until the date changed since stamp"
+            cursor = Transaction().connection.cursor()
+            where = (keys_where(key_ids)
+                & (move.company == company_id)
+                & (move.effective_date <= date)
+                & (Coalesce(move.write_date, move.create_date) > stamp))
+            if data.get('from_date'):
+                where &= (move.effective_date >= from_date)
+            query = move.select(*key_columns(move), where=where,
+                group_by=key_columns(move))
+            cursor.execute(*query)
+            changed = {(row[0], row[1] if lot_grouping else None)
+                for row in cursor}
+            return [k for k in key_ids if k in changed]
+
+        def compute_checkpoint_quantities(key_ids):
+            "Return the totals from the checkpoints and the later moves"
+            # The moves written after the stamp may not be included in the
+            # stored totals
+            stamp_now = Checkpoint.get_stamp()
+            checkpoints = Checkpoint.get_totals(company_id, warehouse_ids,
+                data.get('from_date'), key_ids)
+            # The checkpoints stored without a requested bucket are not used
+            required = {(warehouse_id, name)
+                for warehouse_id in warehouse_ids
+                for name in parameters['buckets']}
+            checkpoints = {key_id: checkpoint
+                for key_id, checkpoint in checkpoints.items()
+                if required <= set(checkpoint[2])}
+            groups = defaultdict(list)
+            for key_id in key_ids:
+                date, stamp = checkpoints.get(key_id, (None, None))[:2]
+                if date is not None and date > to_date:
+                    date = stamp = None
+                groups[date, stamp].append(key_id)
+            # The keys with moves changed before their checkpoint are
+            # computed again from the start
+            for (date, stamp), sub_key_ids in list(groups.items()):
+                if date is not None:
+                    changed = compute_changed(sub_key_ids, date, stamp)
+                    if changed:
+                        groups[date, stamp] = [
+                            k for k in sub_key_ids if k not in changed]
+                        groups[None, None].extend(changed)
+
+            result = defaultdict(int)
+            to_store = []
+            for (date, stamp), sub_key_ids in groups.items():
+                if not sub_key_ids:
+                    continue
+                if date is not None:
+                    for key_id in sub_key_ids:
+                        for (warehouse_id, name), quantity in (
+                                checkpoints[key_id][2].items()):
+                            result[key_id, warehouse_id, name] += quantity
+                if date is None or date < to_date:
+                    where = sql_common_where & keys_where(sub_key_ids)
+                    if date is not None:
+                        where &= (move.effective_date > date)
+                    sub_keys = set(sub_key_ids)
+                    for (key_id, warehouse_id, name), quantity in (
+                            compute_quantites(where).items()):
+                        if key_id in sub_keys:
+                            result[key_id, warehouse_id, name] += quantity
+                if checkpoint_date and date != checkpoint_date:
+                    to_store.extend(sub_key_ids)
+            if to_store:
+                Checkpoint.store(company_id, warehouse_ids,
+                    data.get('from_date'), checkpoint_date, stamp_now, {
+                        key_id: {
+                            (warehouse_id, name): result.get(
+                                (key_id, warehouse_id, name), 0)
+                            for warehouse_id in warehouse_ids
+                            for name in parameters['buckets']}
+                        for key_id in to_store})
+            return result
+
+        def compute_chunk(key_ids):
+            "Return the stocks, totals, moves ids and periods of the keys"
+            product_ids = list({product_id for product_id, lot_id in key_ids})
+            lot_ids = None
+            if lot_filter:
+                lot_ids = list({lot_id for product_id, lot_id in key_ids})
+            key_where = keys_where(key_ids)
+            sql_where = sql_common_where & key_where
+
+            cache_key = cached = None
+            # The watermark reads all the moves of the keys while the
+            # checkpoints only read the moves after them, so they are not
+            # cached
+            if not use_checkpoint:
+                with measure('watermark'):
+                    watermark = compute_watermark(key_where)
+                cache_key = (company_id, tuple(warehouse_ids),
+                    data.get('from_date'),
+                    data.get('to_date'), lot_breakdown,
+                    parameters['period'], parameters['reconcile'],
+                    tuple(optional), tuple(key_ids),
+                    tuple(watermark))
+                cached = cls._prepare_cache.get(cache_key)
+            if cached is None:
+                with measure('quantities'):
+                    if use_ledger:
+                        totals = compute_ledger_quantities(
+                            product_ids, lot_ids)
+                    elif use_checkpoint:
+                        totals = compute_checkpoint_quantities(key_ids)
+                    else:
+                        totals = compute_quantites(sql_where)
+                with measure('initial_stock'):
+                    initial_stocks = dict(
+                        compute_initial_stock(product_ids, lot_ids))
+                periods = {}
+                if parameters['period']:
+                    with measure('periods'):
+                        periods = compute_periods(sql_where)
+                final_stocks = {}
+                if parameters['reconcile']:
+                    with measure('final_stock'):
+                        final_stocks = dict(
+                            compute_final_stock(product_ids, lot_ids))
+                cached = (initial_stocks, dict(totals), periods,
+                    final_stocks)
+                if cache_key is not None:
+                    cls._prepare_cache.set(cache_key, cached)
+            elif diagnostics is not None:
+                diagnostics.add_cache_hit()
+            initial_stocks, totals, periods, final_stocks = cached
+            # The ids of the moves are not cached because the cache size is
+            # a number of chunks whatever the number of their moves
+            moves = {}
+            if with_moves:
+                with measure('moves'):
+                    moves = compute_moves(sql_where)
+            return initial_stocks, totals, moves, periods, final_stocks
+
+        def measure_chunk(key_ids):
+            with measure('chunks', keys=len(key_ids)):
+                return compute_chunk(key_ids)
+
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        transaction_context = transaction.context.copy()
+
+        def compute_chunk_in_transaction(key_ids):
+            # Only ids and quantities are returned so nothing read in the
+            # read-only transaction of the worker is used outside of it
+            with cls._worker_transaction(database_name, user,
+                    transaction_context):
+                return measure_chunk(key_ids)
+
+        def compute_ahead(executor, chunks, workers):
+            "Yield the results of the chunks in order"
+            # Only as many chunks as workers are computed ahead of the one
+            # being rendered so their results do not pile up in memory
+            chunks = iter(chunks)
+            pending = deque()
+            for sub_keys in islice(chunks, workers):
+                pending.append(executor.submit(
+                        compute_chunk_in_transaction, key_ids(sub_keys)))
+            while pending:
+                result = pending.popleft().result()
+                for sub_keys in islice(chunks, 1):
+                    pending.append(executor.submit(
+                            compute_chunk_in_transaction, key_ids(sub_keys)))
+                yield result
+
+        def key_ids(sub_keys):
+            return [(product.id, lot.id if lot else None)
+                for product, lot in sub_keys]
+
+        def generate_records():
+            # Records are computed one chunk of keys at a time so only the
+            # moves of the chunk being rendered are kept in memory
+            workers = cls._workers()
+            chunk_size = cls._chunk_size()
+            if workers > 1:
+                chunk_size = min(chunk_size,
+                    max(-(-len(keys) // workers), 1))
+            chunks = [list(c) for c in grouped_slice(keys, chunk_size)]
+            with ExitStack() as stack:
+                if workers > 1 and len(chunks) > 1:
+                    executor = stack.enter_context(cls._executor(workers))
+                    results = compute_ahead(executor, chunks, workers)
+                else:
+                    results = (measure_chunk(key_ids(c)) for c in chunks)
+                for sub_keys, cached in zip(chunks, results):
+                    yield from build_records(sub_keys, cached)
+
+        def expand_lots(sub_keys, initial_stocks, totals, moves):
+            "Return the keys of the lots of the products with stock or moves"
+            lot_ids = defaultdict(set)
+            for (product_id, lot_id), warehouse_id, name in chain(
+                    totals, moves):
+                lot_ids[product_id].add(lot_id)
+            for (warehouse_id, product_id, lot_id), quantity in (
+                    initial_stocks.items()):
+                if quantity:
+                    lot_ids[product_id].add(lot_id)
+            lots = {l.id: l for l in Lot.browse(
+                    [i for ids in lot_ids.values() for i in ids
+                        if i is not None])}
+
+            def order(lot_id):
+                return (lot_id is None,
+                    lots[lot_id].number if lot_id is not None else '')
+            for product, lot in sub_keys:
+                for lot_id in sorted(lot_ids[product.id] or {None},
+                        key=order):
+                    yield product, lots.get(lot_id)
+
+        def build_records(sub_keys, cached):
+            initial_stocks, totals, moves, periods, final_stocks = cached
+            if lot_breakdown:
+                sub_keys = list(expand_lots(
+                        sub_keys, initial_stocks, totals, moves))
+            rows = {}
+            if with_moves:
+                with measure('rows'):
+                    rows = cls._get_rows(
+                        [i for ids in moves.values() for i in ids])
+            if diagnostics is not None:
+                for (key_id, warehouse_id, name), ids in moves.items():
+                    diagnostics.add_moves(key_id, warehouse_id, name,
+                        len(ids))
+
+            for product, lot in sub_keys:
+                key_id = (product.id, lot.id if lot else None)
+                for warehouse in warehouses:
+                    key = ((warehouse.id, product.id, lot.id if lot else None)
+                        if lot_grouping else (warehouse.id, product.id))
+                    initial_stock = initial_stocks.get(key, 0)
+
+                    record = cls._get_record(product, lot, warehouse,
+                        initial_stock, {
+                            name: (
+                                totals.get(
+                                    (key_id, warehouse.id, name), 0),
+                                [rows[i] for i in moves.get(
+                                        (key_id, warehouse.id, name),
+                                        [])])
+                            for name in bucket_names})
+                    if parameters['period']:
+                        record['periods'] = [
+                            dict(values, date=date,
+                                balance=product.default_uom.round(
+                                    initial_stock + values['balance']))
+                            for date, values in sorted(periods.get(
+                                    (key_id, warehouse.id), {}).items())]
+                    if parameters['reconcile']:
+                        # The moves missing from the buckets make the total
+                        # differ from the stock of the warehouse
+                        record['final_stock'] = final_stocks.get(key, 0)
+                        record['mismatch'] = bool(product.default_uom.round(
+                                record['final_stock'] - record['total']))
+                    yield record
+
+        return generate_records(), parameters
+
+    @classmethod
+    def _get_locations(cls, warehouse):
+        "Return the classification of the locations for the warehouse"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        try:
+            Production = pool.get('production')
+        except:
+            Production = None
+
+        # The warehouse tree is matched with the nested set of the locations
+        # so the queries do not inline the ids of all its locations
+        bounds = cls._locations_cache.get(warehouse.id)
+        if bounds is None:
+            bounds = (warehouse.left, warehouse.right)
+            cls._locations_cache.set(warehouse.id, bounds)
+        locations = {}
+        locations['warehouse'] = bounds
+        # The types of the registered buckets are classified, so another
+        # module only has to register a bucket to classify a type
+        types = {t for t, name in Location.type.selection} - {'warehouse'}
+        if not Production:
+            types.discard('production')
+        locations['types'] = []
+        for bucket in cls._get_bucket_registry():
+            for predicate in [bucket.from_, bucket.to]:
+                if (predicate in types
+                        and predicate not in locations['types']):
+                    locations['types'].append(predicate)
+        return locations
+
+    @classmethod
+    def _get_bucket_registry(cls):
+        "Return the buckets the moves are classified in, in report order"
+        # The first bucket whose locations match gives the bucket of a move
+        # and the titles are translated when the report is drawn
+        return [
+            Bucket('supplier_incommings', 'Supplier Incomming',
+                'supplier', 'warehouse', 1, cls._draw_table_shipment),
+            Bucket('supplier_returns', 'Supplier Returns',
+                'warehouse', 'supplier', -1, cls._draw_table),
+            Bucket('customer_outgoings', 'Customer Outgoings',
+                'warehouse', 'customer', -1, cls._draw_table_shipment),
+            Bucket('customer_returns', 'Customer Returns',
+                'customer', 'warehouse', 1, cls._draw_table_shipment),
+            Bucket('production_outs', 'Production Out',
+                'production', 'warehouse', 1,
+                lambda key, records, parameters: (
+                    cls._draw_table_production(key, 'production_output',
+                        records, parameters))),
+            Bucket('production_ins', 'Production In',
+                'warehouse', 'production', -1,
+                lambda key, records, parameters: (
+                    cls._draw_table_production(key, 'production_input',
+                        records, parameters))),
+            Bucket('lost_found_from', 'From Lost & Found',
+                'lost_found', 'warehouse', 1, cls._draw_table,
+                section='lost_found'),
+            Bucket('lost_found_to', 'To Lost & Found',
+                'warehouse', 'lost_found', -1, cls._draw_table,
+                section='lost_found'),
+            Bucket('in_to', 'Entries from outside warehouse',
+                'outside', 'warehouse', 1, cls._draw_table),
+            Bucket('out_to', 'Outputs from our warehouse',
+                'warehouse', 'outside', -1, cls._draw_table),
+            # The moves inside the warehouse do not change its stock and
+            # they are many in a warehouse with input and output locations
+            Bucket('internal_transfers', 'Internal Transfers',
+                'warehouse', 'warehouse', 0, cls._draw_table, optional=True),
+            ]
+
+    @classmethod
+    def _get_bucket_sections(cls):
+        "Return the title of the sections grouping several buckets"
+        return {
+            'lost_found': 'Inventory',
+            }
+
+    @classmethod
+    def _get_bucket_names(cls):
+        return [b.name for b in cls._get_bucket_registry()]
+
+    @classmethod
+    def _get_outgoing_bucket_names(cls):
+        "Return the names of the buckets decreasing the stock"
+        return [b.name for b in cls._get_bucket_registry() if b.sign < 0]
+
+    @classmethod
+    def _in_warehouse(cls, column, locations):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        location = Location.__table__()
+        left, right = locations['warehouse']
+        return column.in_(location.select(location.id,
+                where=(location.left >= left) & (location.right <= right)))
+
+    @classmethod
+    def _in_types(cls, column, types):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        location = Location.__table__()
+        return column.in_(location.select(location.id,
+                where=location.type.in_(types)))
+
+    @classmethod
+    def _in_locations(cls, column, predicate, locations):
+        "Return the condition of the column matching the location predicate"
+        if predicate == 'warehouse':
+            return cls._in_warehouse(column, locations)
+        elif predicate == 'outside':
+            return (~cls._in_warehouse(column, locations)
+                & ~cls._in_types(column, locations['types']))
+        return cls._in_types(column, [predicate])
+
+    @classmethod
+    def _get_active_buckets(cls, locations, optional=()):
+        "Return the buckets whose location types exist and are requested"
+        predicates = {'warehouse', 'outside'} | set(locations['types'])
+        return [b for b in cls._get_bucket_registry()
+            if b.from_ in predicates and b.to in predicates
+            and (not b.optional or b.name in optional)]
+
+    @classmethod
+    def _get_buckets(cls, move, locations, optional=()):
+        "Return the list of bucket names and conditions"
+        return [(b.name,
+                cls._in_locations(move.from_location, b.from_, locations)
+                & cls._in_locations(move.to_location, b.to, locations))
+            for b in cls._get_active_buckets(locations, optional)]
+
+    @classmethod
+    def _classify(cls, move, locations, optional=()):
+        "Return the bucket of the moves and the condition of the classified"
+        # All the buckets are tested by a single case so the moves are
+        # classified in a single scan whatever the number of buckets.
+        # The buckets of the moves inside the warehouse are tested before
+        # the others so a move inside the warehouse never falls in a bucket
+        # crossing it.
+        internal = {b.name
+            for b in cls._get_active_buckets(locations, optional)
+            if b.from_ == b.to == 'warehouse'}
+        buckets = cls._get_buckets(move, locations, optional)
+        buckets.sort(key=lambda b: b[0] not in internal)
+        # Only the moves of a bucket are read, whatever its locations
+        where = (Or([condition for name, condition in buckets])
+            if buckets else Literal(False))
+        case = Case(*((condition, name) for name, condition in buckets))
+        return case, where
+
+    @classmethod
+    def _explain(cls, query):
+        "Return the plan of the query and if it uses the index of the moves"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'postgresql':
+            explain = 'EXPLAIN '
+            indexes = Table('pg_indexes')
+            index_query = indexes.select(indexes.indexname,
+                where=(indexes.tablename == Move._table)
+                & indexes.indexdef.like('%(product, effective_date)%'))
+        elif backend.name == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+            indexes = Table('sqlite_master')
+            index_query = indexes.select(indexes.name,
+                where=(indexes.type == 'index')
+                & (indexes.tbl_name == Move._table)
+                & indexes.sql.like('%product%effective_date%'))
+        else:
+            return
+        query, params = tuple(query)
+        cursor.execute(explain + query, params)
+        plan = [str(row[-1]) for row in cursor]
+        cursor.execute(*index_query)
+        names = [name for name, in cursor]
+        return {
+            'plan': plan,
+            'index_used': any(
+                name in line for name in names for line in plan),
+            }
+
+    @classmethod
+    def _diagnostics_enabled(cls):
+        "Return if the time and queries of the report must be collected"
+        return (Transaction().context.get('stock_move_location_diagnostics')
+            or config.getboolean('stock_move_location_report', 'diagnostics',
+                default=False))
+
+    @classmethod
+    def _workers(cls):
+        "Return the number of threads computing the chunks of keys"
+        return config.getint('stock_move_location_report', 'workers',
+            default=1)
+
+    @classmethod
+    def _executor(cls, workers):
+        "Return the executor computing the chunks of keys"
+        return ThreadPoolExecutor(max_workers=workers)
+
+    @classmethod
+    def _worker_transaction(cls, database_name, user, context):
+        "Return the transaction in which a worker computes a chunk"
+        return Transaction().start(database_name, user, readonly=True,
+            context=context)
+
+    @classmethod
+    def _chunk_size(cls):
+        "Return the maximum number of products or lots queried at once"
+        return config.getint('stock_move_location_report', 'chunk_size',
+            default=backend.MAX_QUERY_PARAMS)
+
+    @classmethod
+    def _get_record(cls, product, lot, warehouse, initial_stock,
+            quantities):
+        record = {
+            'product': DualRecord(product),
+            'lot': DualRecord(lot),
+            'warehouse': DualRecord(warehouse),
+            'initial_stock': initial_stock,
+            }
+        total = initial_stock
+        for bucket in cls._get_bucket_registry():
+            quantity, moves = quantities.get(bucket.name, (0, []))
+            # The totals are shown with the sign they add to the stock
+            if bucket.sign:
+                quantity = bucket.sign * quantity
+                total += quantity
+            record['%s_total' % bucket.name] = quantity or 0
+            record[bucket.name] = moves
+            if bucket.section:
+                name = '%s_total' % bucket.section
+                record.setdefault(name, 0)
+                if bucket.sign:
+                    record[name] += quantity
+        record['total'] = total
+        return record
+
+    @classmethod
+    def _get_rows(cls, move_ids):
+        "Return the values of the detail rows of the moves read in bulk"
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        production_fields = [n for n in ['production_input',
+                'production_output'] if n in Move._fields]
+        fields_names = ['rec_name', 'quantity', 'effective_date', 'unit',
+            'unit.symbol', 'origin', 'shipment'] + production_fields
+        if 'lot' in Move._fields:
+            fields_names += ['lot', 'lot.number']
+
+        def reference(value):
+            if value:
+                model, id_ = value.split(',')
+                if int(id_) >= 0:
+                    return model, int(id_)
+
+        chunk_size = cls._chunk_size()
+        moves = []
+        references = defaultdict(set)
+        for sub_ids in grouped_slice(move_ids, chunk_size):
+            for values in Move.read(list(sub_ids), fields_names):
+                moves.append(values)
+                for name in ['origin', 'shipment']:
+                    if reference(values[name]):
+                        model, id_ = reference(values[name])
+                        references[model].add(id_)
+                for name in production_fields:
+                    if values[name] is not None:
+                        references['production'].add(values[name])
+
+        # Origins and shipments are read once per model
+        related = {}
+        for model, ids in references.items():
+            Model = pool.get(model)
+            names = ['rec_name']
+            if 'warehouse' in Model._fields:
+                names.append('warehouse.rec_name')
+            for sub_ids in grouped_slice(list(ids), chunk_size):
+                for values in Model.read(list(sub_ids), names):
+                    warehouse = values.get('warehouse.')
+                    related[model, values['id']] = (values['rec_name'],
+                        warehouse['rec_name'] if warehouse else '')
+
+        rows = {}
+        for values in moves:
+            origin = reference(values['origin'])
+            shipment = reference(values['shipment'])
+            lot = values.get('lot.')
+            row = {
+                'id': values['id'],
+                'rec_name': values['rec_name'],
+                'quantity': values['quantity'],
+                'effective_date': values['effective_date'],
+                'unit': values['unit.']['symbol'],
+                'lot': (lot['id'], lot['number']) if lot else None,
+                'origin': (origin + (related[origin][0],)
+                    if origin else None),
+                'warehouse': related[shipment][1] if shipment else '',
+                }
+            for name in production_fields:
+                production = values[name]
+                row[name] = (related['production', production][1]
+                    if production is not None else '')
+            rows[values['id']] = row
+        return rows
+
+    @classmethod
+    def _get_location_domain(cls, field, predicate, warehouse, locations):
+        "Return the domain of the field matching the location predicate"
+        if predicate == 'warehouse':
+            return [(field, 'child_of', [warehouse.id], 'parent')]
+        elif predicate == 'outside':
+            return [
+                (field, 'not child_of', [warehouse.id], 'parent'),
+                ('%s.type' % field, 'not in', locations['types']),
+                ]
+        return [('%s.type' % field, '=', predicate)]
+
+    @classmethod
+    def _get_detail_domains(cls, warehouse, locations, data):
+        "Return the domain of the moves of each bucket for the warehouse"
+        domain = [
+            ('state', '=', 'done'),
+            ('company', '=', Transaction().context.get('company')),
+            ]
+        if data.get('from_date'):
+            domain.append(('effective_date', '>=', data['from_date']))
+        if data.get('to_date'):
+            domain.append(('effective_date', '<=', data['to_date']))
+        # The same classification as _get_buckets for the client
+        buckets = {}
+        sections = defaultdict(lambda: ['OR'])
+        for bucket in cls._get_bucket_registry():
+            buckets[bucket.name] = (
+                cls._get_location_domain('from_location', bucket.from_,
+                    warehouse, locations)
+                + cls._get_location_domain('to_location', bucket.to,
+                    warehouse, locations))
+            if bucket.section:
+                sections[bucket.section].append(buckets[bucket.name])
+        buckets.update(sections)
+        return {name: domain + [bucket] for name, bucket in buckets.items()}
+
+    @classmethod
+    def _get_detail_domain(cls, record, name, parameters):
+        "Return the domain of the moves of the bucket of the record"
+        domain = parameters['detail_domains'][record['warehouse'].raw.id][name]
+        domain = domain + [('product', '=', record['product'].raw.id)]
+        if record['lot'].raw:
+            domain.append(('lot', '=', record['lot'].raw.id))
+        elif parameters.get('by_lot'):
+            domain.append(('lot', '=', None))
+        return domain
+
+    @classmethod
+    def _detail_url(cls, record, name, title, parameters):
+        "Return the URL of the client listing the moves of the bucket"
+        def encode(value):
+            return quote(json.dumps(value, cls=JSONEncoder,
+                    separators=(',', ':')))
+
+        return '%s/model/stock.move;domain=%s;name=%s' % (
+            parameters['base_url'],
+            encode(cls._get_detail_domain(record, name, parameters)),
+            encode(str(title)))
 
     @classmethod
     def _origin(cls, record, parameters):
-        origin = str(record.raw.origin)
-        model, id_ = origin.split(',')
+        model, id_, rec_name = record['origin']
         label = _('Origin')
         if model == 'sale.line':
             label = _('Sale Line')
@@ -292,141 +1308,268 @@ class PrintStockMoveLocationReport(DominateReport):
             label = _('Move')
         if model == 'production':
             label = _('Production')
-        return a(record.origin.render.rec_name,
-            href='%s/model/%s/%s;name="%s"' % (
-                parameters['base_url'], model, id_, label))
+        return cls._link(parameters, model, id_, label, escape(rec_name))
+
+    @classmethod
+    def _link(cls, parameters, model, id_, name, content):
+        "Return the HTML link to the record with the escaped content"
+        return _LINK.format(
+            escape('%s/model/%s/%s;name="%s"' % (
+                    parameters['base_url'], model, id_, name)),
+            content)
+
+    @classmethod
+    def _draw_title(cls, key, title, parameters):
+        if parameters.get('totals_only') or parameters.get('link_details'):
+            return span(i(cls='fas fa-angle-double-right'), raw(' ' + title))
+        return a(i(cls='fas fa-angle-double-right'), raw(' ' + title),
+            href='#%s' % key,
+            cls='',
+            **{
+                'data-toggle': 'collapse',
+                'role': 'button',
+                'aria-expanded': 'false',
+                'aria-controls': key,
+            })
+
+    @classmethod
+    def _render_table(cls, attributes, headers, rows):
+        "Return the detail table of the rows of escaped cells"
+        # The rows are formatted as strings because a tree of tags for each
+        # cell is too slow for reports with many moves
+        row_template = '<tr>%s</tr>' % ('<td>{}</td>' * len(headers))
+        parts = [
+            '<table %s>' % ' '.join('%s="%s"' % (name, escape(value))
+                for name, value in attributes.items()),
+            '<thead><tr>',
+            ]
+        parts.extend('<th scope="col">%s</th>' % escape(header)
+            for header in headers)
+        parts.append('</tr></thead><tbody>')
+        parts.extend(row_template.format(*cells) for cells in rows)
+        parts.append('</tbody></table>')
+        return raw(''.join(parts))
+
+    @classmethod
+    def _draw_cells(cls, record, parameters, quantity_name=None,
+            location=None):
+        "Return the escaped cells of the detail row of the move"
+        cells = []
+        if parameters.get('lot'):
+            lot = record['lot']
+            cells.append(cls._link(parameters, 'stock.lot', lot[0],
+                    _('Lots'), escape(lot[1])) if lot else '')
+        quantity = escape(html_render(record['quantity']))
+        if quantity_name:
+            quantity = cls._link(parameters, 'stock.move', record['id'],
+                quantity_name, quantity)
+        cells.append(quantity)
+        cells.append(escape(record['unit']))
+        cells.append(cls._origin(record, parameters)
+            if record['origin'] else '')
+        cells.append(escape(html_render(record['effective_date'])))
+        if location:
+            cells.append(escape(record[location]))
+        cells.append(cls._link(parameters, 'stock.move', record['id'],
+                _('Move'), _ARROW))
+        return cells
 
     @classmethod
     def _draw_table_shipment(cls, key, records, parameters):
-        table_attrs = {'cls': 'table collapse multi-collapse', 'id': key}
-        detail_table = table(**table_attrs)
-        with detail_table:
-            with thead():
-                with tr():
-                    if parameters.get('lot'):
-                        th(_('Lot'), scope='col')
-                    th(_('Quantity'), scope='col')
-                    th(_('UdM'), scope='col')
-                    th(_('Origin'), scope='col')
-                    th(_('Effective Date'), scope='col')
-                    th(_('Warehouse'), scope='col')
-                    th('', scope='col')
-            with tbody():
-                for record in records:
-                    with tr():
-                        if parameters.get('lot'):
-                            with td():
-                                if getattr(record.raw, 'lot', None):
-                                    a(record.lot.render.number,
-                                        href='%s/model/stock.lot/%s;name="%s"' % (
-                                            parameters['base_url'],
-                                            record.lot.raw.id,
-                                            _('Lots')))
-                        td(record.render.quantity)
-                        td(record.uom.render.symbol)
-                        with td() as origin_cell:
-                            if record.origin:
-                                origin_cell.add(cls._origin(record, parameters))
-                        td(record.render.effective_date)
-                        td(record.shipment.warehouse.render.rec_name
-                            if record.shipment and record.shipment.warehouse else '')
-                        with td():
-                            a(i(cls='fas fa-arrow-right'),
-                                href='%s/model/stock.move/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    record.raw.id,
-                                    _('Move')))
-        return detail_table
+        headers = [_('Quantity'), _('UdM'), _('Origin'), _('Effective Date'),
+            _('Warehouse'), '']
+        if parameters.get('lot'):
+            headers.insert(0, _('Lot'))
+        return cls._render_table(
+            {'class': 'table collapse multi-collapse', 'id': key}, headers,
+            (cls._draw_cells(record, parameters, location='warehouse')
+                for record in records))
 
     @classmethod
     def _draw_table_production(cls, key, in_out, records, parameters):
-        detail_table = table(cls='table collapse multi-collapse', id=key)
-        with detail_table:
-            with thead():
-                with tr():
-                    if parameters.get('lot'):
-                        th(_('Lot'), scope='col')
-                    th(_('Quantity'), scope='col')
-                    th(_('UdM'), scope='col')
-                    th(_('Origin'), scope='col')
-                    th(_('Effective Date'), scope='col')
-                    th(_('Warehouse'), scope='col')
-                    th('', scope='col')
-            with tbody():
-                for record in records:
-                    production = getattr(record, in_out)
-                    with tr():
-                        if parameters.get('lot'):
-                            with td():
-                                if getattr(record.raw, 'lot', None):
-                                    a(record.lot.render.number,
-                                        href='%s/model/stock.lot/%s;name="%s"' % (
-                                            parameters['base_url'],
-                                            record.lot.raw.id,
-                                            _('Lots')))
-                        with td():
-                            a(record.render.quantity,
-                                href='%s/model/stock.move/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    record.raw.id,
-                                    _('Move')))
-                        td(record.uom.render.symbol)
-                        with td() as origin_cell:
-                            if record.origin:
-                                origin_cell.add(cls._origin(record, parameters))
-                        td(record.render.effective_date)
-                        td(production.warehouse.render.rec_name)
-                        with td():
-                            a(i(cls='fas fa-arrow-right'),
-                                href='%s/model/stock.move/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    record.raw.id,
-                                    _('Move')))
-        return detail_table
+        headers = [_('Quantity'), _('UdM'), _('Origin'), _('Effective Date'),
+            _('Warehouse'), '']
+        if parameters.get('lot'):
+            headers.insert(0, _('Lot'))
+        return cls._render_table(
+            {'class': 'table collapse multi-collapse', 'id': key}, headers,
+            (cls._draw_cells(record, parameters, quantity_name=_('Move'),
+                    location=in_out)
+                for record in records))
 
     @classmethod
     def _draw_table(cls, key, records, parameters):
-        attrs = {'cls': 'table collapse multi-collapse', 'id': key} if key else {'cls': 'table'}
-        detail_table = table(**attrs)
-        with detail_table:
-            with thead():
+        attributes = ({'class': 'table collapse multi-collapse', 'id': key}
+            if key else {'class': 'table'})
+        headers = [_('Quantity'), _('UdM'), _('Origin'), _('Effective Date'),
+            '']
+        if parameters.get('lot'):
+            headers.insert(0, _('Lot'))
+        return cls._render_table(attributes, headers,
+            (cls._draw_cells(record, parameters,
+                    quantity_name=record['rec_name'])
+                for record in records))
+
+    @classmethod
+    def _draw_bucket(cls, key, title, name, records, parameters,
+            draw_detail=None):
+        section = container()
+        with section:
+            with tr():
+                with td() as title_cell:
+                    title_cell.add(cls._draw_title(key, title, parameters))
+                for record in records:
+                    total = '%s %s' % (
+                        html_render(record['%s_total' % name]),
+                        record['product'].default_uom.render.symbol)
+                    if parameters.get('link_details'):
+                        td(a(total, href=cls._detail_url(
+                                    record, name, title, parameters)))
+                    else:
+                        td(total)
+            if (draw_detail and not parameters['totals_only']
+                    and not parameters.get('link_details')):
+                with tr():
+                    with td(colspan=str(len(records) + 1)) as detail_cell:
+                        for record in records:
+                            if len(records) > 1:
+                                strong(record['warehouse'].render.rec_name)
+                            detail_cell.add(draw_detail(record))
+        return section.render()
+
+    @classmethod
+    def _draw_section(cls, key, section, record, parameters):
+        "Draw the totals and the moves of the buckets of the section"
+        section_table = table(cls='table collapse multi-collapse', id=key)
+        with section_table:
+            for bucket in cls._get_bucket_registry():
+                if bucket.section != section or not record[bucket.name]:
+                    continue
+                with tr():
+                    with td():
+                        i(cls='fas fa-angle-double-right')
+                        raw(' ' + _(bucket.title))
+                    td('%s %s' % (
+                        html_render(record['%s_total' % bucket.name]),
+                        record['product'].default_uom.render.symbol))
                 with tr():
-                    if parameters.get('lot'):
-                        th(_('Lot'), scope='col')
-                    th(_('Quantity'), scope='col')
-                    th(_('UdM'), scope='col')
-                    th(_('Origin'), scope='col')
-                    th(_('Effective Date'), scope='col')
-                    th('', scope='col')
-            with tbody():
+                    with td(colspan='2') as detail_cell:
+                        detail_cell.add(bucket.draw(
+                                '', record[bucket.name], parameters))
+        return section_table
+
+    @classmethod
+    def _draw_product(cls, records, parameters):
+        return tr(td(h3(records[0]['product'].render.rec_name),
+                colspan=str(len(records) + 1))).render()
+
+    @classmethod
+    def _draw_record(cls, records, parameters):
+        "Draw the records of the same key with a column for each warehouse"
+        record = records[0]
+        header = container()
+        with header:
+            with tr():
+                with td():
+                    strong(_('Product:'))
+                    raw(' %s' % record['product'].render.rec_name)
+                with td(colspan=str(len(records))):
+                    if record['lot']:
+                        strong(_('Lot:'))
+                        raw(' %s' % record['lot'].render.number)
+            with tr():
+                with td():
+                    strong(_('Warehouse:'))
+                for record in records:
+                    td(record['warehouse'].render.rec_name)
+            with tr():
+                td(_('Initial Stock'))
                 for record in records:
-                    with tr():
-                        if parameters.get('lot'):
-                            with td():
-                                if getattr(record.raw, 'lot', None):
-                                    a(record.lot.render.number,
-                                        href='%s/model/stock.lot/%s;name="%s"' % (
-                                            parameters['base_url'],
-                                            record.lot.raw.id,
-                                            _('Lots')))
-                        with td():
-                            a(record.render.quantity,
-                                href='%s/model/stock.move/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    record.raw.id,
-                                    record.render.rec_name))
-                        td(record.uom.render.symbol)
-                        with td() as origin_cell:
-                            if record.origin:
-                                origin_cell.add(cls._origin(record, parameters))
-                        td(record.render.effective_date)
-                        with td():
-                            a(i(cls='fas fa-arrow-right'),
-                                href='%s/model/stock.move/%s;name="%s"' % (
-                                    parameters['base_url'],
-                                    record.raw.id,
-                                    _('Move')))
-        return detail_table
+                    td(html_render(record['initial_stock']))
+        yield header.render()
+
+        sections = cls._get_bucket_sections()
+        drawn = set()
+        for bucket in cls._get_bucket_registry():
+            if bucket.name not in parameters['buckets']:
+                continue
+            if bucket.section:
+                # The buckets of a section are drawn together
+                if bucket.section not in drawn:
+                    drawn.add(bucket.section)
+                    key = bucket.section.replace('_', '-')
+                    yield cls._draw_bucket(key,
+                        _(sections[bucket.section]), bucket.section,
+                        records, parameters,
+                        lambda r, key=key, section=bucket.section: (
+                            cls._draw_section(key, section, r, parameters)))
+                continue
+            key = bucket.name.replace('_', '-')
+            yield cls._draw_bucket(key, _(bucket.title), bucket.name,
+                records, parameters,
+                lambda r, key=key, bucket=bucket: bucket.draw(
+                    key, r[bucket.name], parameters))
+
+        footer = container()
+        with footer:
+            with tr():
+                td(_('Total'))
+                for record in records:
+                    td('%s %s' % (
+                        html_render(record['total']),
+                        record['product'].default_uom.render.symbol))
+            if parameters.get('reconcile'):
+                with tr():
+                    td(_('Warehouse Stock'))
+                    for record in records:
+                        cell = td('%s %s' % (
+                                html_render(record['final_stock']),
+                                record['product'].default_uom.render.symbol))
+                        if record['mismatch']:
+                            cell['class'] = 'table-danger'
+        yield footer.render()
+
+        if parameters.get('period'):
+            yield cls._draw_periods(records, parameters)
+
+    @classmethod
+    def _draw_periods(cls, records, parameters):
+        "Draw the quantities by period with the balance for each warehouse"
+        titles = {b.name: _(b.title) for b in cls._get_bucket_registry()}
+        section = container()
+        with section:
+            with tr():
+                with td(colspan=str(len(records) + 1)) as title_cell:
+                    title_cell.add(cls._draw_title('periods', _('Periods'),
+                            dict(parameters, totals_only=False,
+                                link_details=False)))
+            with tr():
+                with td(colspan=str(len(records) + 1)) as detail_cell:
+                    for record in records:
+                        if len(records) > 1:
+                            strong(record['warehouse'].render.rec_name)
+                        # Only the kinds of move of the periods are shown
+                        names = [n for n in cls._get_bucket_names()
+                            if any(n in p for p in record['periods'])]
+                        detail_table = detail_cell.add(table(
+                                cls='table collapse multi-collapse',
+                                id='periods'))
+                        with detail_table:
+                            with thead():
+                                with tr():
+                                    th(_('Period'), scope='col')
+                                    for name in names:
+                                        th(titles[name], scope='col')
+                                    th(_('Balance'), scope='col')
+                            with tbody():
+                                for period in record['periods']:
+                                    with tr():
+                                        td(html_render(period['date']))
+                                        for name in names:
+                                            td(html_render(
+                                                    period.get(name, 0)))
+                                        td(html_render(period['balance']))
+        return section.render()
 
     @classmethod
     def css(cls, action, data, records):
@@ -443,270 +1586,42 @@ class PrintStockMoveLocationReport(DominateReport):
     def body(cls, action, data, records):
         parameters = data['parameters']
         wrapper = div()
+        rows = wrapper.add(table(cls='table')).add(tbody())
+        with rows:
+            with tr():
+                with td():
+                    h1(_('Stock Move Location'))
+                with td(align='right'):
+                    company = parameters.get('company')
+                    if company:
+                        a(company.render.rec_name,
+                            href=parameters['base_url'],
+                            alt=company.render.rec_name)
+                    button(_('Expand All'),
+                        type='button',
+                        cls='btn tn-outline-light btn-sm',
+                        onclick='expand()')
+            if parameters.get('show_date'):
+                with tr():
+                    with td():
+                        strong(_('From Date:'))
+                        raw(' %s' % html_render(parameters['from_date']))
+                    with td():
+                        strong(_('To Date:'))
+                        raw(' %s' % html_render(parameters['to_date']))
+        # Each record is serialized and released as soon as it is drawn so
+        # the whole report is never kept as a tree of tags
+        product = None
+        for (key_product, key_lot), key_records in groupby(data['records'],
+                key=lambda r: (r['product'].raw, r['lot'].raw)):
+            key_records = list(key_records)
+            # The lots are drawn under their product
+            if parameters.get('by_lot') and key_product != product:
+                product = key_product
+                rows.add(raw(cls._draw_product(key_records, parameters)))
+            for fragment in cls._draw_record(key_records, parameters):
+                rows.add(raw(fragment))
         with wrapper:
-            with table(cls='table'):
-                with tbody():
-                    with tr():
-                        with td():
-                            h1(_('Stock Move Location'))
-                        with td(align='right'):
-                            company = parameters.get('company')
-                            if company:
-                                a(company.render.rec_name,
-                                    href=parameters['base_url'],
-                                    alt=company.render.rec_name)
-                            button(_('Expand All'),
-                                type='button',
-                                cls='btn tn-outline-light btn-sm',
-                                onclick='expand()')
-                    if parameters.get('show_date'):
-                        with tr():
-                            with td():
-                                strong(_('From Date:'))
-                                raw(' %s' % html_render(parameters['from_date']))
-                            with td():
-                                strong(_('To Date:'))
-                                raw(' %s' % html_render(parameters['to_date']))
-                    for record in data['records']:
-                        with tr():
-                            with td():
-                                strong(_('Product:'))
-                                raw(' %s' % record['product'].render.rec_name)
-                            with td():
-                                if record['lot']:
-                                    strong(_('Lot:'))
-                                    raw(' %s' % record['lot'].render.number)
-                        with tr():
-                            with td():
-                                strong(_('Warehouse:'))
-                                raw(' %s' % parameters['warehouse'])
-                            td('')
-                        with tr():
-                            td(_('Initial Stock'))
-                            td(html_render(record['initial_stock']))
-                        with tr():
-                            with td():
-                                with a(href='#supplier-incommings',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'supplier-incommings',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Supplier Incomming'))
-                            td('%s %s' % (
-                                html_render(record['supplier_incommings_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table_shipment(
-                                    'supplier-incommings',
-                                    record['supplier_incommings'],
-                                    parameters))
-                        with tr():
-                            with td():
-                                with a(href='#supplier-returns',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'supplier-returns',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Supplier Returns'))
-                            td('%s %s' % (
-                                html_render(record['supplier_returns_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table(
-                                    'supplier-returns',
-                                    record['supplier_returns'],
-                                    parameters))
-                        with tr():
-                            with td():
-                                with a(href='#customer-outgoings',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'customer-outgoings',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Customer Outgoings'))
-                            td('%s %s' % (
-                                html_render(record['customer_outgoings_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table_shipment(
-                                    'customer-outgoings',
-                                    record['customer_outgoings'],
-                                    parameters))
-                        with tr():
-                            with td():
-                                with a(href='#customer-returns',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'customer-returns',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Customer Returns'))
-                            td('%s %s' % (
-                                html_render(record['customer_returns_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table_shipment(
-                                    'customer-returns',
-                                    record['customer_returns'],
-                                    parameters))
-                        if parameters.get('production'):
-                            with tr():
-                                with td():
-                                    with a(href='#production-outs',
-                                        cls='',
-                                        **{
-                                            'data-toggle': 'collapse',
-                                            'role': 'button',
-                                            'aria-expanded': 'false',
-                                            'aria-controls': 'production-outs',
-                                        }):
-                                        i(cls='fas fa-angle-double-right')
-                                        raw(' ' + _('Production Out'))
-                                td('%s %s' % (
-                                    html_render(record['production_outs_total']),
-                                    record['product'].default_uom.render.symbol))
-                            with tr():
-                                with td(colspan='2') as detail_cell:
-                                    detail_cell.add(cls._draw_table_production(
-                                        'production-outs',
-                                        'production_output',
-                                        record['production_outs'],
-                                        parameters))
-                            with tr():
-                                with td():
-                                    with a(href='#production-ins',
-                                        cls='',
-                                        **{
-                                            'data-toggle': 'collapse',
-                                            'role': 'button',
-                                            'aria-expanded': 'false',
-                                            'aria-controls': 'production-ins',
-                                        }):
-                                        i(cls='fas fa-angle-double-right')
-                                        raw(' ' + _('Production In'))
-                                td('%s %s' % (
-                                    html_render(record['production_ins_total']),
-                                    record['product'].default_uom.render.symbol))
-                            with tr():
-                                with td(colspan='2') as detail_cell:
-                                    detail_cell.add(cls._draw_table_production(
-                                        'production-ins',
-                                        'production_input',
-                                        record['production_ins'],
-                                        parameters))
-                        with tr():
-                            with td():
-                                with a(href='#inventory',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'inventory',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Inventory'))
-                            td('%s %s' % (
-                                html_render(record['lost_found_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2'):
-                                with table(cls='table collapse multi-collapse',
-                                        id='inventory'):
-                                    if record['lost_found_from']:
-                                        with tr():
-                                            with td():
-                                                i(cls='fas fa-angle-double-right')
-                                                raw(' ' + _('From Lost & Found'))
-                                            td('%s %s' % (
-                                                html_render(record['lost_found_from_total']),
-                                                record['product'].default_uom.render.symbol))
-                                        with tr():
-                                            with td(colspan='2') as detail_cell:
-                                                detail_cell.add(cls._draw_table(
-                                                    '',
-                                                    record['lost_found_from'],
-                                                    parameters))
-                                    if record['lost_found_to']:
-                                        with tr():
-                                            with td():
-                                                i(cls='fas fa-angle-double-right')
-                                                raw(' ' + _('To Lost & Found'))
-                                            td('%s %s' % (
-                                                html_render(record['lost_found_to_total']),
-                                                record['product'].default_uom.render.symbol))
-                                        with tr():
-                                            with td(colspan='2') as detail_cell:
-                                                detail_cell.add(cls._draw_table(
-                                                    '',
-                                                    record['lost_found_to'],
-                                                    parameters))
-                        with tr():
-                            with td():
-                                with a(href='#in-to',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'in-to',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Entries from outside warehouse'))
-                            td('%s %s' % (
-                                html_render(record['in_to_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table(
-                                    'in-to',
-                                    record['in_to'],
-                                    parameters))
-                        with tr():
-                            with td():
-                                with a(href='#out-to',
-                                    cls='',
-                                    **{
-                                        'data-toggle': 'collapse',
-                                        'role': 'button',
-                                        'aria-expanded': 'false',
-                                        'aria-controls': 'out-to',
-                                    }):
-                                    i(cls='fas fa-angle-double-right')
-                                    raw(' ' + _('Outputs from our warehouse'))
-                            td('%s %s' % (
-                                html_render(record['out_to_total']),
-                                record['product'].default_uom.render.symbol))
-                        with tr():
-                            with td(colspan='2') as detail_cell:
-                                detail_cell.add(cls._draw_table(
-                                    'out-to',
-                                    record['out_to'],
-                                    parameters))
-                        with tr():
-                            td(_('Total'))
-                            td('%s %s' % (
-                                html_render(record['total']),
-                                record['product'].default_uom.render.symbol))
             script(src='https://code.jquery.com/jquery-3.3.1.slim.min.js',
                 integrity='sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo',
                 crossorigin='anonymous')
@@ -721,11 +1636,60 @@ function expand() {
   $('.collapse').collapse('show');
 }
 """), type='text/javascript', charset='utf-8')
+            if parameters.get('diagnostics') is not None:
+                script(raw(json.dumps(parameters['diagnostics'].as_dict())),
+                    type='application/json',
+                    id='stock-move-location-diagnostics')
         return wrapper
 
     @classmethod
     def execute(cls, ids, data):
+        pool = Pool()
+        Execution = pool.get('stock.move.location.report.execution')
         records, parameters = cls.prepare(data)
+        execution_id = Transaction().context.get(
+            'stock_move_location_execution')
+        if execution_id is not None:
+            records = Execution.track_progress(
+                execution_id, records, parameters)
+        diagnostics = parameters['diagnostics']
+        # The records are computed while they are rendered so the execute
+        # phase includes all the other phases
+        with (diagnostics.measure('execute') if diagnostics is not None
+                else nullcontext()):
+            result = cls._execute_records(ids, data, records, parameters)
+        if diagnostics is not None:
+            diagnostics.log()
+            oext, content, direct_print, name = result
+            if oext == 'html':
+                content = cls._set_html_diagnostics(content, diagnostics)
+                result = oext, content, direct_print, name
+        return result
+
+    @classmethod
+    def _set_html_diagnostics(cls, content, diagnostics):
+        "Return the HTML content with the diagnostics of all the phases"
+        # The script is drawn while the execute phase is still measured
+        encoded = isinstance(content, bytes)
+        if encoded:
+            content = content.decode('utf-8')
+        marker = 'id="stock-move-location-diagnostics">'
+        start = content.find(marker)
+        if start >= 0:
+            start += len(marker)
+            end = content.index('</script>', start)
+            content = (content[:start]
+                + json.dumps(diagnostics.as_dict()) + content[end:])
+        if encoded:
+            content = content.encode('utf-8')
+        return content
+
+    @classmethod
+    def _execute_records(cls, ids, data, records, parameters):
+        "Return the report result of the prepared records"
+        output_format = data.get('output_format') or 'html'
+        if output_format != 'html':
+            return cls._export(records, parameters, output_format)
         return super().execute(ids, {
             'name': 'stock.move.location.report',
             'model': data['model'],
@@ -735,4 +1699,845 @@ function expand() {
             'report_options': {
                 'now': datetime.now(),
                 }
-            })
\ No newline at end of file
+            })
+
+    @classmethod
+    def _export(cls, records, parameters, output_format):
+        "Return the report result of the records in a data format"
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        action_reports = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ], limit=1)
+        name = (action_reports[0].name if action_reports
+            else 'stock_move_location')
+        lines = cls._get_export_lines(records, parameters)
+        content = getattr(cls, '_export_%s' % output_format)(lines)
+        return output_format, content, False, name
+
+    @classmethod
+    def _get_export_columns(cls):
+        return ['product', 'lot', 'warehouse', 'bucket', 'quantity', 'unit',
+            'move', 'effective_date', 'origin', 'period']
+
+    @classmethod
+    def _get_export_lines(cls, records, parameters):
+        "Yield one line per total, per move and per period of the records"
+        bucket_names = ['initial_stock'] + [n for n in cls._get_bucket_names()
+            if n in parameters['buckets']]
+        for record in records:
+            product = record['product'].raw
+            lot = record['lot'].raw
+            common = {
+                'product': product.rec_name,
+                'lot': lot.number if lot else None,
+                'warehouse': record['warehouse'].raw.rec_name,
+                'period': None,
+                }
+            unit = product.default_uom.symbol
+            for name in bucket_names + ['total']:
+                quantity = record[name if name in {'initial_stock', 'total'}
+                    else '%s_total' % name]
+                yield dict(common, bucket=name, quantity=quantity,
+                    unit=unit, move=None, effective_date=None, origin=None)
+                if name in {'initial_stock', 'total'}:
+                    continue
+                for row in record[name]:
+                    origin = row['origin']
+                    yield dict(common,
+                        lot=row['lot'][1] if row['lot'] else common['lot'],
+                        bucket=name,
+                        quantity=row['quantity'],
+                        unit=row['unit'],
+                        move=row['id'],
+                        effective_date=(row['effective_date'].isoformat()
+                            if row['effective_date'] else None),
+                        origin='%s,%s' % origin[:2] if origin else None)
+            if parameters.get('reconcile'):
+                yield dict(common, bucket='final_stock',
+                    quantity=record['final_stock'], unit=unit, move=None,
+                    effective_date=None, origin=None)
+                if record['mismatch']:
+                    yield dict(common, bucket='difference',
+                        quantity=record['final_stock'] - record['total'],
+                        unit=unit, move=None, effective_date=None,
+                        origin=None)
+            for period in record.get('periods', []):
+                for name in bucket_names[1:] + ['balance']:
+                    if name in period:
+                        yield dict(common, bucket=name,
+                            quantity=period[name], unit=unit, move=None,
+                            effective_date=None, origin=None,
+                            period=period['date'].isoformat())
+
+    @classmethod
+    def _write_export(cls, write):
+        "Return the content written by write to a text file"
+        # The lines are encoded as they are written and the file is spooled
+        # to the disk once it is large, so the export is never kept as a
+        # single string
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as content:
+            output = io.TextIOWrapper(content, encoding='utf-8', newline='')
+            write(output)
+            output.flush()
+            output.detach()
+            content.seek(0)
+            return content.read()
+
+    @classmethod
+    def _export_csv(cls, lines):
+        def write(output):
+            writer = csv.DictWriter(output, cls._get_export_columns())
+            writer.writeheader()
+            for line in lines:
+                writer.writerow(line)
+        return cls._write_export(write)
+
+    @classmethod
+    def _export_jsonl(cls, lines):
+        def write(output):
+            for line in lines:
+                output.write(json.dumps(line))
+                output.write('\n')
+        return cls._write_export(write)
+
+    @classmethod
+    def _export_ods(cls, lines):
+        # The spreadsheet is written directly as it only contains one table
+        # of plain values
+        def cell(value):
+            if value is None:
+                return '<table:table-cell/>'
+            if isinstance(value, (int, float)):
+                return ('<table:table-cell office:value-type="float" '
+                    'office:value="%s"/>' % value)
+            return ('<table:table-cell office:value-type="string">'
+                '<text:p>%s</text:p></table:table-cell>' % xml_escape(
+                    str(value)))
+
+        columns = cls._get_export_columns()
+        mimetype = 'application/vnd.oasis.opendocument.spreadsheet'
+
+        def write_content(output):
+            output.write('<?xml version="1.0" encoding="UTF-8"?>'
+                '<office:document-content '
+                'xmlns:office='
+                '"urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+                'xmlns:table='
+                '"urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+                'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+                'office:version="1.2"><office:body><office:spreadsheet>'
+                '<table:table table:name="Stock Move Location">')
+            output.write('<table:table-row>%s</table:table-row>' % ''.join(
+                    cell(c) for c in columns))
+            for line in lines:
+                output.write('<table:table-row>%s</table:table-row>'
+                    % ''.join(cell(line[c]) for c in columns))
+            output.write('</table:table></office:spreadsheet></office:body>'
+                '</office:document-content>')
+
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as content:
+            with zipfile.ZipFile(content, 'w') as archive:
+                # The mimetype must be the first entry and not compressed
+                archive.writestr('mimetype', mimetype,
+                    compress_type=zipfile.ZIP_STORED)
+                archive.writestr('META-INF/manifest.xml',
+                    '<?xml version="1.0" encoding="UTF-8"?>'
+                    '<manifest:manifest xmlns:manifest='
+                    '"urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+                    'manifest:version="1.2">'
+                    '<manifest:file-entry manifest:full-path="/" '
+                    'manifest:media-type="%s"/>'
+                    '<manifest:file-entry manifest:full-path="content.xml" '
+                    'manifest:media-type="text/xml"/>'
+                    '</manifest:manifest>' % mimetype,
+                    compress_type=zipfile.ZIP_DEFLATED)
+                # The rows are compressed as they are written
+                info = zipfile.ZipInfo('content.xml',
+                    date_time=time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as entry:
+                    output = io.TextIOWrapper(entry, encoding='utf-8')
+                    write_content(output)
+                    output.flush()
+                    output.detach()
+            content.seek(0)
+            return content.read()
+
+
+class PrintStockMoveLocationExecution(ModelSQL, ModelView):
+    'Stock Move Location Execution'
+    __name__ = 'stock.move.location.report.execution'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    data = fields.Dict(None, 'Data', readonly=True)
+    state = fields.Selection([
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True)
+    progress = fields.Float('Progress', digits=(1, 4), readonly=True)
+    report = fields.Binary('Report', filename='report_name', readonly=True)
+    report_name = fields.Char('Report Name', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_progress():
+        return 0
+
+    @classmethod
+    def _update(cls, execution_id, values):
+        # Executions are only written in their own transaction so the
+        # progress is visible while the report is generated
+        with Transaction().new_transaction() as transaction:
+            cls.write([cls(execution_id)], values)
+            transaction.commit()
+
+    @classmethod
+    def _progress_interval(cls):
+        "Return the minimum number of seconds between two progress updates"
+        return 5
+
+    @classmethod
+    def track_progress(cls, execution_id, records, parameters):
+        "Yield the records while storing the progress of the execution"
+        # The progress is the share of the keys of the report whose records
+        # are all yielded because the lots of a product are only known once
+        # its moves are computed
+        if parameters.get('by_lot'):
+            def key(record):
+                return record['product'].raw
+        else:
+            def key(record):
+                return record['product'].raw, record['lot'].raw
+        count = parameters['count']
+        done, previous_key = 0, None
+        # Each update commits a transaction so they are throttled
+        updated = time.monotonic()
+        for record in records:
+            record_key = key(record)
+            if previous_key is not None and record_key != previous_key:
+                done += 1
+            previous_key = record_key
+            yield record
+            if (count and time.monotonic() - updated
+                    >= cls._progress_interval()):
+                cls._update(execution_id, {'progress': min(done / count, 1)})
+                updated = time.monotonic()
+
+    @classmethod
+    def generate(cls, executions):
+        pool = Pool()
+        Report = pool.get('stock.move.location.report', type='report')
+
+        for execution in executions:
+            cls._update(execution.id, {
+                    'state': 'running',
+                    'progress': 0,
+                    })
+            try:
+                with Transaction().set_context(
+                        company=execution.company.id,
+                        stock_move_location_execution=execution.id):
+                    oext, content, direct_print, name = Report.execute(
+                        [], dict(execution.data))
+            except Exception:
+                cls._update(execution.id, {'state': 'failed'})
+                raise
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            cls._update(execution.id, {
+                    'state': 'done',
+                    'progress': 1,
+                    'report': content,
+                    'report_name': '%s.%s' % (name, oext),
+                    })
+            cls._notify(execution, name)
+
+    @classmethod
+    def _notify(cls, execution, name):
+        "Notify the user who queued the execution that the report is ready"
+        pool = Pool()
+        try:
+            Notification = pool.get('res.notification')
+        except KeyError:
+            return
+        with Transaction().new_transaction() as transaction:
+            Notification.create([{
+                        'user': execution.create_uid.id,
+                        'label': name,
+                        'description': gettext(
+                            'stock_move_location_report'
+                            '.msg_execution_done'),
+                        }])
+            transaction.commit()
+
+
+class Location(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+
+    @classmethod
+    def _clear_move_location_report_cache(cls):
+        Report = Pool().get('stock.move.location.report', type='report')
+        Report._locations_cache.clear()
+        # The cached totals are classified with the previous locations
+        Report._prepare_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls._clear_move_location_report_cache()
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Checkpoint = pool.get('stock.move.location.checkpoint')
+        Ledger = pool.get('stock.move.location.ledger')
+        cls._clear_move_location_report_cache()
+        # The moves are classified with the tree and the type of locations
+        if any({'parent', 'type'} & set(values)
+                for values in args[1::2]):
+            Checkpoint.clear()
+            if Ledger.valid():
+                Ledger.set_valid(False)
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, locations):
+        pool = Pool()
+        Checkpoint = pool.get('stock.move.location.checkpoint')
+        Ledger = pool.get('stock.move.location.ledger')
+        cls._clear_move_location_report_cache()
+        Checkpoint.clear()
+        if Ledger.valid():
+            Ledger.set_valid(False)
+        super().delete(locations)
+
+
+class StockMoveLocationLedger(ModelSQL, ModelView):
+    'Stock Move Location Ledger'
+    __name__ = 'stock.move.location.ledger'
+    _valid_cache = Cache('stock.move.location.ledger.valid', context=False)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        readonly=True, domain=[('type', '=', 'warehouse')])
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    date = fields.Date('Date', required=True, readonly=True)
+    bucket = fields.Selection('get_buckets', 'Bucket', required=True,
+        readonly=True)
+    quantity = fields.Float('Quantity', digits='unit', required=True,
+        readonly=True,
+        help='The quantity in the default unit of the product.')
+    unit = fields.Function(fields.Many2One('product.uom', 'Unit'),
+        'on_change_with_unit')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('line_exclude',
+                Exclude(t, (t.company, Equal), (t.warehouse, Equal),
+                    (t.product, Equal), (t.date, Equal), (t.bucket, Equal)),
+                'stock_move_location_report.msg_ledger_line_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.product, Index.Equality()),
+                (t.warehouse, Index.Equality()),
+                (t.date, Index.Range())))
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def get_buckets(cls):
+        "Return the buckets of the report registry"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Report = pool.get('stock.move.location.report', type='report')
+        buckets = []
+        for bucket in Report._get_bucket_registry():
+            # The title is translated by the message of the bucket, which the
+            # buckets of other modules may not have
+            message = 'msg_bucket_%s' % bucket.name
+            try:
+                ModelData.get_id('stock_move_location_report', message)
+            except KeyError:
+                title = bucket.title
+            else:
+                title = gettext('stock_move_location_report.%s' % message)
+            buckets.append((bucket.name, title))
+        return buckets
+
+    @fields.depends('product')
+    def on_change_with_unit(self, name=None):
+        return self.product.default_uom if self.product else None
+
+    @property
+    def _key(self):
+        lot = getattr(self, 'lot', None)
+        return (self.company.id, self.warehouse.id, self.product.id,
+            lot.id if lot else None, self.bucket, self.date)
+
+    @classmethod
+    def configured(cls):
+        "Return if the ledger is enabled in the configuration"
+        return config.getboolean('stock_move_location_report', 'ledger',
+            default=False)
+
+    @classmethod
+    def enabled(cls):
+        "Return if the report totals are read from the ledger"
+        return cls.configured() and cls.valid()
+
+    @classmethod
+    def valid(cls):
+        "Return if the ledger has been built with the current locations"
+        State = Pool().get('stock.move.location.ledger.state')
+        valid = cls._valid_cache.get(None)
+        if valid is None:
+            with without_check_access():
+                valid = bool(State(1).valid)
+            cls._valid_cache.set(None, valid)
+        return valid
+
+    @classmethod
+    def set_valid(cls, valid):
+        State = Pool().get('stock.move.location.ledger.state')
+        with without_check_access():
+            State.write([State(1)], {'valid': valid})
+        cls._valid_cache.clear()
+
+    @classmethod
+    def _get_line_columns(cls):
+        "Return the names of the columns identifying a ledger line"
+        names = ['company', 'warehouse', 'product', 'date', 'bucket']
+        if 'lot' in cls._fields:
+            names.insert(3, 'lot')
+        return names
+
+    @classmethod
+    def _get_query(cls, warehouse, move, where):
+        "Return the query of the daily quantities by bucket of the moves"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        Report = pool.get('stock.move.location.report', type='report')
+        product = Product.__table__()
+        template = Template.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+
+        locations = Report._get_locations(warehouse)
+        # The ledger keeps all the buckets for any report
+        bucket, classified_where = Report._classify(move, locations, [
+                b.name for b in Report._get_bucket_registry() if b.optional])
+        lot_grouping = 'lot' in cls._fields
+
+        # The quantities are converted in the default unit of the product
+        # so they are summed by the database
+        join = (move
+            .join(product, condition=move.product == product.id)
+            .join(template, condition=product.template == template.id)
+            .join(from_uom, condition=move.unit == from_uom.id)
+            .join(to_uom, condition=template.default_uom == to_uom.id))
+        columns = [move.company, move.product]
+        if lot_grouping:
+            columns.append(move.lot)
+        classified = join.select(*columns,
+            move.effective_date.as_('date'),
+            (move.quantity * from_uom.factor / to_uom.factor
+                ).as_('quantity'),
+            bucket.as_('bucket'),
+            where=where & (move.state == 'done') & classified_where)
+        columns = [classified.company, classified.product]
+        if lot_grouping:
+            columns.append(classified.lot)
+        columns += [classified.date, classified.bucket]
+        return classified.select(
+            Literal(warehouse.id).as_('warehouse'), *columns,
+            Sum(classified.quantity).as_('quantity'),
+            where=classified.bucket != Null,
+            group_by=columns)
+
+    @classmethod
+    def _match(cls, table, query):
+        "Return the condition of the ledger lines of the rows of the query"
+        condition = Literal(True)
+        for name in cls._get_line_columns():
+            column, value = Column(table, name), Column(query, name)
+            if name == 'lot':
+                condition &= Coalesce(column, -1) == Coalesce(value, -1)
+            else:
+                condition &= column == value
+        return condition
+
+    @classmethod
+    def _insert(cls, query, quantity, where=None):
+        "Return the insertion of a ledger line for each row of the query"
+        table = cls.__table__()
+        names = cls._get_line_columns()
+        return table.insert(
+            [Column(table, n) for n in names]
+            + [table.quantity, table.create_uid, table.create_date],
+            query.select(*(Column(query, n) for n in names),
+                quantity, Literal(Transaction().user), CurrentTimestamp(),
+                where=where))
+
+    @classmethod
+    def _add(cls, query, sign=1):
+        "Add the quantities of the query to the lines of their day and bucket"
+        table = cls.__table__()
+        line = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # The missing lines are created empty and the quantities are added by
+        # the database, so concurrent moves of the same day and bucket
+        # neither lose an addition nor create the same line twice. Only the
+        # lines are locked, and a conflict is retried with the transaction.
+        insert = cls._insert(query, Literal(0),
+            where=~Exists(line.select(Literal(1),
+                    where=cls._match(line, query))))
+        if transaction.database.has_insert_on_conflict():
+            insert.on_conflict = Conflict(insert.table)
+        cursor.execute(*insert)
+        cursor.execute(*table.update(
+                [table.quantity, table.write_uid, table.write_date],
+                [table.quantity + query.quantity * sign, transaction.user,
+                    CurrentTimestamp()],
+                from_=[query],
+                where=cls._match(table, query)))
+        cls._clear_transaction_cache()
+
+    @classmethod
+    def _clear_transaction_cache(cls):
+        "Forget the lines read by the transaction before an update in SQL"
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.pop(cls.__name__, None)
+
+    @classmethod
+    def update_moves(cls, moves, sign=1):
+        "Add (or remove with a negative sign) the done moves to the ledger"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+
+        if not cls.enabled() or not moves:
+            return
+        warehouses = set()
+        for m in moves:
+            for location in [m.from_location, m.to_location]:
+                if location.warehouse:
+                    warehouses.add(location.warehouse)
+        for warehouse in warehouses:
+            for sub_ids in grouped_slice(
+                    [m.id for m in moves], backend.MAX_QUERY_PARAMS):
+                cls._add(cls._get_query(warehouse, move,
+                        reduce_ids(move.id, list(sub_ids))), sign)
+
+    @classmethod
+    def rebuild(cls):
+        "Compute again the ledger from all the done moves"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Report = pool.get('stock.move.location.report', type='report')
+        table = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*move.select(move.product,
+                where=move.state == 'done',
+                group_by=[move.product]))
+        product_ids = [p for p, in cursor]
+        # The lines are inserted by the database from the moves of a chunk of
+        # products at a time
+        for warehouse in Location.search([('type', '=', 'warehouse')]):
+            for sub_ids in grouped_slice(product_ids, Report._chunk_size()):
+                query = cls._get_query(warehouse, move,
+                    reduce_ids(move.product, list(sub_ids)))
+                cursor.execute(*cls._insert(query, query.quantity))
+        cls._clear_transaction_cache()
+        cls.set_valid(True)
+        Report._prepare_cache.clear()
+
+
+class StockMoveLocationLedgerLot(metaclass=PoolMeta):
+    __name__ = 'stock.move.location.ledger'
+    lot = fields.Many2One('stock.lot', 'Lot', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # The lines without lot are unique too
+        cls._sql_constraints = [c for c in cls._sql_constraints
+            if c[0] != 'line_exclude']
+        cls._sql_constraints += [
+            ('line_lot_exclude',
+                Exclude(t, (t.company, Equal), (t.warehouse, Equal),
+                    (t.product, Equal), (Coalesce(t.lot, -1), Equal),
+                    (t.date, Equal), (t.bucket, Equal)),
+                'stock_move_location_report.msg_ledger_line_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module):
+        super().__register__(module)
+        table_h = cls.__table_handler__(module)
+        # The lines of the lots of the same day and bucket were not allowed
+        table_h.drop_constraint('line_exclude')
+
+
+class StockMoveLocationLedgerState(ModelSingleton, ModelSQL):
+    'Stock Move Location Ledger State'
+    __name__ = 'stock.move.location.ledger.state'
+    valid = fields.Boolean('Valid',
+        help='If the ledger has been rebuilt since the last change of the '
+        'tree or the type of the locations.')
+
+    @staticmethod
+    def default_valid():
+        return False
+
+
+class RebuildStockMoveLocationLedger(Wizard):
+    'Rebuild Stock Move Location Ledger'
+    __name__ = 'stock.move.location.ledger.rebuild'
+    start_state = 'rebuild'
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        Ledger = Pool().get('stock.move.location.ledger')
+        Ledger.rebuild()
+        return 'end'
+
+
+class StockMoveLocationCheckpoint(ModelSQL):
+    'Stock Move Location Checkpoint'
+    __name__ = 'stock.move.location.checkpoint'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        ondelete='CASCADE', domain=[('type', '=', 'warehouse')])
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+    from_date = fields.Date('From Date')
+    date = fields.Date('Date', required=True)
+    stamp = fields.Timestamp('Stamp', required=True,
+        help='The time of the transaction that computed the quantities.')
+    bucket = fields.Char('Bucket', required=True)
+    quantity = fields.Float('Quantity', required=True,
+        help='The quantity in the default unit of the product.')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.product, Index.Equality()),
+                (t.warehouse, Index.Equality()),
+                (t.from_date, Index.Equality())))
+
+    @property
+    def _key(self):
+        lot = getattr(self, 'lot', None)
+        return (self.product.id, lot.id if lot else None)
+
+    @classmethod
+    def enabled(cls):
+        "Return if the report totals are computed from the checkpoints"
+        return config.getboolean('stock_move_location_report', 'checkpoint',
+            default=False)
+
+    @classmethod
+    def margin(cls):
+        "Return the time subtracted from the stamp of the checkpoints"
+        return timedelta(seconds=config.getint('stock_move_location_report',
+                'checkpoint_margin', default=300))
+
+    @classmethod
+    def get_stamp(cls):
+        """Return the time before which all the moves written are visible to
+        the transaction"""
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        cursor.execute(*Select([CurrentTimestamp()]))
+        stamp, = cursor.fetchone()
+        if isinstance(stamp, str):
+            stamp = datetime.fromisoformat(stamp)
+        # The moves are written with the start time of their transaction, so
+        # the moves of the transactions still running when the snapshot was
+        # taken are older than the current time but not visible
+        if backend.name == 'postgresql':
+            activity = Table('pg_stat_activity')
+            cursor.execute(*activity.select(Min(activity.xact_start),
+                    where=activity.datname == transaction.database.name))
+            oldest, = cursor.fetchone()
+            if oldest is not None:
+                stamp = min(stamp, oldest)
+        # The transactions committed between the snapshot and the reading of
+        # the activity are only covered by the margin
+        return stamp - cls.margin()
+
+    @classmethod
+    def _search_keys(cls, company_id, warehouse_ids, from_date, key_ids):
+        keys = set(key_ids)
+        product_ids = list({product_id for product_id, lot_id in key_ids})
+        for sub_ids in grouped_slice(product_ids, backend.MAX_QUERY_PARAMS):
+            for checkpoint in cls.search([
+                        ('company', '=', company_id),
+                        ('warehouse', 'in', warehouse_ids),
+                        ('from_date', '=', from_date),
+                        ('product', 'in', list(sub_ids)),
+                        ]):
+                if checkpoint._key in keys:
+                    yield checkpoint
+
+    @classmethod
+    def get_totals(cls, company_id, warehouse_ids, from_date, key_ids):
+        """Return the date, timestamp and bucket totals of the warehouses
+        for the keys with a checkpoint"""
+        checkpoints = defaultdict(list)
+        with without_check_access():
+            for checkpoint in cls._search_keys(
+                    company_id, warehouse_ids, from_date, key_ids):
+                checkpoints[checkpoint._key].append(checkpoint)
+
+        result = {}
+        for key_id, lines in checkpoints.items():
+            # The warehouses must have been stored by the same run
+            stamps = {(l.date, l.stamp) for l in lines}
+            if (len(stamps) == 1
+                    and {l.warehouse.id for l in lines} == set(warehouse_ids)):
+                date, stamp = stamps.pop()
+                result[key_id] = (date, stamp, {
+                        (l.warehouse.id, l.bucket): l.quantity
+                        for l in lines})
+        return result
+
+    @classmethod
+    def store(cls, company_id, warehouse_ids, from_date, date, stamp,
+            totals):
+        "Replace the checkpoints of the keys by their totals at the date"
+        vlist = []
+        for (product_id, lot_id), quantities in totals.items():
+            for (warehouse_id, bucket), quantity in quantities.items():
+                values = {
+                    'company': company_id,
+                    'warehouse': warehouse_id,
+                    'product': product_id,
+                    'from_date': from_date,
+                    'date': date,
+                    'stamp': stamp,
+                    'bucket': bucket,
+                    'quantity': quantity,
+                    }
+                if 'lot' in cls._fields:
+                    values['lot'] = lot_id
+                vlist.append(values)
+        # The report may be executed in a read-only transaction and the
+        # checkpoints are only an optimization so a failure is not an error
+        try:
+            with Transaction().new_transaction() as transaction, \
+                    without_check_access():
+                cls.delete(list(cls._search_keys(
+                            company_id, warehouse_ids, from_date,
+                            list(totals))))
+                cls.create(vlist)
+                transaction.commit()
+        except backend.DatabaseOperationalError:
+            logger.warning('Unable to store the stock move location '
+                'checkpoints', exc_info=True)
+
+    @classmethod
+    def clear(cls):
+        "Remove all the checkpoints"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete())
+
+
+class StockMoveLocationCheckpointLot(metaclass=PoolMeta):
+    __name__ = 'stock.move.location.checkpoint'
+    lot = fields.Many2One('stock.lot', 'Lot', ondelete='CASCADE')
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        # The report reads the done moves of the products by date and
+        # classifies them with the locations
+        cls._sql_indexes.add(
+            Index(t,
+                (t.product, Index.Equality()),
+                (t.effective_date, Index.Range()),
+                include=cls._move_location_report_index_include(t),
+                where=t.state == 'done'))
+        # The checkpoints of the report are checked against the moves of the
+        # products written since they were computed. The index is updated by
+        # every write of a move, so it is only added with the checkpoints.
+        if config.getboolean('stock_move_location_report', 'checkpoint',
+                default=False):
+            cls._sql_indexes.add(
+                Index(t,
+                    (t.product, Index.Equality()),
+                    (Coalesce(t.write_date, t.create_date), Index.Range())))
+
+    @classmethod
+    def _move_location_report_index_include(cls, table):
+        return [table.from_location, table.to_location, table.company,
+            table.unit, table.quantity]
+
+    @classmethod
+    def do(cls, moves):
+        Ledger = Pool().get('stock.move.location.ledger')
+        to_do = [m.id for m in moves if m.state != 'done']
+        super().do(moves)
+        Ledger.update_moves(
+            [m for m in cls.browse(to_do) if m.state == 'done'])
+
+    @classmethod
+    def cancel(cls, moves):
+        Ledger = Pool().get('stock.move.location.ledger')
+        if ('done', 'cancelled') in cls._transitions:
+            Ledger.update_moves(
+                [m for m in moves if m.state == 'done'], sign=-1)
+        super().cancel(moves)
+
+
+class MoveLot(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def _move_location_report_index_include(cls, table):
+        return super()._move_location_report_index_include(table) + [
+            table.lot]
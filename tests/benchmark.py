@@ -0,0 +1,243 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Benchmark of the stock move location report on synthetic moves.
+
+Run it with the same environment as the tests, for example:
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.stock_move_location_report.tests.benchmark \\
+        --products 50 --lots 2 --moves 5 --depth 5 --output results.jsonl
+
+Each run appends one JSON line with the parameters and, for the data and
+render phases, the wall time, the memory peak, the number of SQL statements
+and the number of rows fetched.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import tracemalloc
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (activate_module, CONTEXT, DB_NAME,
+    USER)
+from trytond.transaction import Transaction
+from trytond.modules.stock_move_location_report.stock import _Diagnostics
+
+
+def measure(function):
+    "Return the result of function and its wall time, memory and queries"
+    diagnostics = _Diagnostics()
+    tracemalloc.start()
+    try:
+        with diagnostics.measure('run'):
+            result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    values = diagnostics.phases['run']
+    return result, {
+        'time': values['time'],
+        'memory_peak': peak,
+        'statements': values['statements'],
+        'rows': values['rows'],
+        }
+
+
+def create_data(products, lots, moves, depth, productions):
+    "Create the synthetic products and moves and return the report data"
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+    try:
+        Lot = pool.get('stock.lot')
+    except KeyError:
+        Lot = None
+
+    company = pool.get('company.company')(Transaction().context['company'])
+    unit, = Uom.search([('name', '=', 'Unit')])
+    warehouse, = Location.search([('code', '=', 'WH')])
+    supplier, = Location.search([('code', '=', 'SUP')])
+    customer, = Location.search([('code', '=', 'CUS')])
+    lost_found, = Location.search([('type', '=', 'lost_found')], limit=1)
+
+    # The moves are done in the deepest location of the warehouse tree
+    storage = warehouse.storage_location
+    for level in range(depth):
+        storage, = Location.create([{
+                    'name': 'Level %s' % level,
+                    'type': 'storage',
+                    'parent': storage.id,
+                    }])
+    outside, = Location.create([{
+                'name': 'Outside',
+                'type': 'storage',
+                }])
+    buckets = [
+        (supplier, storage),
+        (storage, supplier),
+        (storage, customer),
+        (customer, storage),
+        (lost_found, storage),
+        (storage, lost_found),
+        (outside, storage),
+        (storage, outside),
+        ]
+    if productions:
+        production = Location.search([('type', '=', 'production')], limit=1)
+        if not production:
+            production = Location.create([{
+                        'name': 'Production',
+                        'type': 'production',
+                        }])
+        production, = production
+        buckets += [
+            (production, storage),
+            (storage, production),
+            ]
+
+    templates = Template.create([{
+                'name': 'Benchmark %s' % i,
+                'type': 'goods',
+                'default_uom': unit.id,
+                } for i in range(products)])
+    products = Product.create([{'template': t.id} for t in templates])
+    product_lots = {p: [None] for p in products}
+    if Lot and lots:
+        for product in products:
+            product_lots[product] = Lot.create([{
+                        'number': '%s-%s' % (product.id, i),
+                        'product': product.id,
+                        } for i in range(lots)])
+
+    # Only the moves from or to the supplier or the customer have a price
+    prices = {(f, t): Move(from_location=f, to_location=t
+            ).on_change_with_unit_price_required() for f, t in buckets}
+
+    random.seed(0)
+    today = date.today()
+    values = []
+    for product in products:
+        for lot in product_lots[product]:
+            for from_location, to_location in buckets:
+                for _ in range(moves):
+                    value = {
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': random.randint(1, 100),
+                        'from_location': from_location.id,
+                        'to_location': to_location.id,
+                        'effective_date': today - timedelta(
+                            days=random.randint(0, 365)),
+                        'company': company.id,
+                        }
+                    if prices[from_location, to_location]:
+                        value['unit_price'] = Decimal('1')
+                        value['currency'] = company.currency.id
+                    if lot:
+                        value['lot'] = lot.id
+                    values.append(value)
+    Move.do(Move.create(values))
+
+    if Lot and lots:
+        model = 'stock.lot'
+        ids = [l.id for p in products for l in product_lots[p]]
+    else:
+        model = 'product.product'
+        ids = [p.id for p in products]
+    return {
+        'from_date': today - timedelta(days=180),
+        'to_date': today,
+        'warehouses': [warehouse.id],
+        'totals_only': False,
+        'model': model,
+        'ids': ids,
+        }
+
+
+def run(options):
+    "Return the result of the benchmark run with the options"
+    modules = ['stock_move_location_report']
+    if options.lots:
+        modules.append('stock_lot')
+    if options.productions:
+        modules.append('production')
+    activate_module(modules)
+
+    from trytond.modules.company.tests import create_company, set_company
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            company = create_company()
+            with set_company(company):
+                data = create_data(options.products, options.lots,
+                    options.moves, options.depth, options.productions)
+                data['totals_only'] = options.totals_only
+                data['output_format'] = options.format
+                Report = Pool().get('stock.move.location.report',
+                    type='report')
+                Report._prepare_cache.clear()
+
+                def prepare():
+                    with Transaction().set_context(
+                            stock_move_location_diagnostics=True):
+                        records, parameters = Report.prepare(data)
+                        return list(records), parameters
+
+                (records, parameters), data_phase = measure(prepare)
+                diagnostics = parameters['diagnostics'].as_dict()
+                data_phase['phases'] = diagnostics['phases']
+                data_phase['plans'] = diagnostics['plans']
+                _, render_phase = measure(
+                    lambda: Report._execute_records(
+                        [], data, records, parameters))
+        finally:
+            transaction.rollback()
+
+    return {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'backend': backend.name,
+        'parameters': vars(options),
+        'records': len(records),
+        'data': data_phase,
+        'render': render_phase,
+        }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stock move location report.')
+    parser.add_argument('--products', type=int, default=10,
+        help='the number of products')
+    parser.add_argument('--lots', type=int, default=0,
+        help='the number of lots per product')
+    parser.add_argument('--moves', type=int, default=5,
+        help='the number of moves per bucket, product and lot')
+    parser.add_argument('--depth', type=int, default=3,
+        help='the depth of the location tree of the warehouse')
+    parser.add_argument('--productions', action='store_true',
+        help='create moves from and to production locations')
+    parser.add_argument('--totals-only', action='store_true',
+        help='compute only the totals')
+    parser.add_argument('--format', default='html',
+        choices=['html', 'csv', 'jsonl', 'ods'],
+        help='the output format rendered')
+    parser.add_argument('--output', type=argparse.FileType('a'),
+        default=sys.stdout, help='the file where the result is appended')
+    options = parser.parse_args(arguments)
+    output = options.output
+    del options.output
+    result = run(options)
+    output.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
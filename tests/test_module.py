@@ -2,18 +2,38 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import json
+from concurrent.futures import Executor, Future
+from contextlib import nullcontext
+from datetime import datetime, timedelta
 from decimal import Decimal
+from unittest.mock import patch
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.modules.company.tests import (CompanyTestMixin, create_company,
     set_company)
 from trytond.modules.html_report.engine import DualRecord
+from trytond.modules.stock_move_location_report.stock import Bucket
+
+
+class SerialExecutor(Executor):
+    "Run the tasks in the calling thread when they are submitted"
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
 
 
 class StockMoveLocationReportTestCase(CompanyTestMixin, ModuleTestCase):
     'Test StockMoveLocationReport module'
     module = 'stock_move_location_report'
+    extras = ['stock_lot']
 
     @with_transaction()
     def test_tracebility_report(self):
@@ -57,9 +77,16 @@ class StockMoveLocationReportTestCase(CompanyTestMixin, ModuleTestCase):
 
             session_id, _, _ = PrintStockMoveLocation.create()
             print_stock_move_location = PrintStockMoveLocation(session_id)
-            print_stock_move_location.start.warehouse = storage.warehouse
+            print_stock_move_location.start.warehouses = [storage.warehouse]
             print_stock_move_location.start.from_date = None
             print_stock_move_location.start.to_date = None
+            print_stock_move_location.start.totals_only = False
+            print_stock_move_location.start.link_details = False
+            print_stock_move_location.start.by_lot = False
+            print_stock_move_location.start.period = None
+            print_stock_move_location.start.reconcile = False
+            print_stock_move_location.start.internal_transfers = False
+            print_stock_move_location.start.output_format = 'html'
             with Transaction().set_context(active_ids=[product.id], active_model='product.product'):
                 _, data = print_stock_move_location.do_print_(None)
                 records, parameters = PrintStockMoveLocationReport.prepare(data)
@@ -67,6 +94,774 @@ class StockMoveLocationReportTestCase(CompanyTestMixin, ModuleTestCase):
                 self.assertEqual(type(record['product']), DualRecord)
                 self.assertEqual(record['supplier_incommings_total'], 146)
                 self.assertEqual(len(record['supplier_incommings']), 4)
+                self.assertEqual(
+                    sorted(r['quantity'] for r in record['supplier_incommings']),
+                    [1, 10, 35, 100])
+
+    def create_product(self, uom='Unit'):
+        "Return a new goods product in the unit of measure"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+
+        unit, = Uom.search([('name', '=', uom)])
+        template, = Template.create([{
+                    'name': 'Test Move',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        return product
+
+    def create_moves(self, product, moves, **values):
+        "Create and do the moves of the product from (quantity, from, to)"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Company = pool.get('company.company')
+
+        company = Company(Transaction().context['company'])
+        to_create = []
+        for quantity, from_location, to_location in moves:
+            move_values = {
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'company': company.id,
+                }
+            # Only the moves from or to the supplier or the customer have a
+            # price
+            if Move(from_location=from_location, to_location=to_location
+                    ).on_change_with_unit_price_required():
+                move_values['unit_price'] = Decimal('1')
+                move_values['currency'] = company.currency.id
+            move_values.update(values)
+            to_create.append(move_values)
+        moves = Move.create(to_create)
+        Move.do(moves)
+        return moves
+
+    def create_supplier_moves(self):
+        "Return a product with 146 units received and its report data"
+        pool = Pool()
+        Location = pool.get('stock.location')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        product = self.create_product()
+        self.create_moves(product, [
+                (quantity, supplier, storage)
+                for quantity in [10, 100, 1, 35]])
+        data = {
+            'warehouses': [storage.warehouse.id],
+            'model': 'product.product',
+            'ids': [product.id],
+            }
+        return product, data
+
+    @with_transaction()
+    def test_totals_only(self):
+        'Test report with totals only'
+        pool = Pool()
+        Report = pool.get('stock.move.location.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['totals_only'] = True
+            records, parameters = Report.prepare(data)
+            record, = records
+            self.assertEqual(record['supplier_incommings_total'], 146)
+            self.assertEqual(record['supplier_incommings'], [])
+            self.assertEqual(record['total'], 146)
+
+    @with_transaction()
+    def test_export(self):
+        'Test report exported as JSON Lines'
+        pool = Pool()
+        Report = pool.get('stock.move.location.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['output_format'] = 'jsonl'
+            oext, content, _, _ = Report.execute([], data)
+            self.assertEqual(oext, 'jsonl')
+            lines = [json.loads(l) for l in content.decode().splitlines()]
+            total, = [l for l in lines
+                if l['bucket'] == 'supplier_incommings' and not l['move']]
+            self.assertEqual(total['quantity'], 146)
+            self.assertEqual(len([l for l in lines
+                        if l['bucket'] == 'supplier_incommings'
+                        and l['move']]), 4)
+            line, = [l for l in lines if l['bucket'] == 'total']
+            self.assertEqual(line['quantity'], 146)
+
+    @with_transaction()
+    def test_diagnostics(self):
+        'Test diagnostics of the report phases'
+        pool = Pool()
+        Report = pool.get('stock.move.location.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['totals_only'] = True
+            with Transaction().set_context(
+                    stock_move_location_diagnostics=True):
+                records, parameters = Report.prepare(data)
+                list(records)
+            diagnostics = parameters['diagnostics'].as_dict()
+            self.assertEqual(diagnostics['phases']['chunks']['calls'], 1)
+            self.assertGreater(
+                diagnostics['phases']['chunks']['statements'], 0)
+            self.assertIn('quantities', diagnostics['plans'])
+
+    @with_transaction()
+    def test_link_details(self):
+        'Test report totals linked to their moves'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['link_details'] = True
+            records, parameters = Report.prepare(data)
+            record, = records
+            self.assertEqual(record['supplier_incommings_total'], 146)
+            self.assertEqual(record['supplier_incommings'], [])
+            self.assertEqual(len(Move.search(Report._get_detail_domain(
+                            record, 'supplier_incommings', parameters))),
+                4)
+            self.assertEqual(Move.search(Report._get_detail_domain(
+                        record, 'customer_outgoings', parameters)), [])
+
+    @with_transaction()
+    def test_periods(self):
+        'Test report quantities by period'
+        pool = Pool()
+        Report = pool.get('stock.move.location.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['totals_only'] = True
+            data['period'] = 'month'
+            records, parameters = Report.prepare(data)
+            record, = records
+            period, = record['periods']
+            self.assertEqual(period['supplier_incommings'], 146)
+            self.assertEqual(period['balance'], 146)
+
+    @with_transaction()
+    def test_periods_rounding(self):
+        'Test quantities by period converted and rounded to the product unit'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        gram, = Uom.search([('name', '=', 'Gram')])
+
+        company = create_company()
+        with set_company(company):
+            product = self.create_product('Kilogram')
+            self.create_moves(product, [
+                    (100, supplier, storage),
+                    (200, supplier, storage),
+                    ], unit=gram.id)
+            records, parameters = Report.prepare({
+                    'warehouses': [storage.warehouse.id],
+                    'model': 'product.product',
+                    'ids': [product.id],
+                    'totals_only': True,
+                    'period': 'month',
+                    })
+            record, = records
+            period, = record['periods']
+            self.assertEqual(period['supplier_incommings'], 0.3)
+            self.assertEqual(period['balance'], 0.3)
+            self.assertEqual(record['supplier_incommings_total'], 0.3)
+
+    @with_transaction()
+    def test_reconcile(self):
+        'Test final stock reconciled with the stock of the warehouse'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        storage, = Location.search([('code', '=', 'STO')])
+        lost_found, = Location.search([('type', '=', 'lost_found')])
+        registry = Report._get_bucket_registry
+
+        def get_bucket_registry():
+            return [b for b in registry() if b.name != 'lost_found_from']
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            data['totals_only'] = True
+            data['reconcile'] = True
+            records, parameters = Report.prepare(data)
+            record, = records
+            self.assertEqual(record['final_stock'], 146)
+            self.assertFalse(record['mismatch'])
+            self.assertNotIn('table-danger',
+                ''.join(Report._draw_record([record], parameters)))
+            self.assertEqual([l['bucket'] for l in Report._get_export_lines(
+                        [record], parameters)
+                    if l['bucket'] in {'final_stock', 'difference'}],
+                ['final_stock'])
+
+            # The inventory adjustments are missing from the buckets
+            self.create_moves(product, [(10, lost_found, storage)])
+            with patch.object(Report, '_get_bucket_registry',
+                    side_effect=get_bucket_registry):
+                records, parameters = Report.prepare(data)
+                record, = records
+                html = ''.join(Report._draw_record([record], parameters))
+            self.assertEqual(record['final_stock'], 156)
+            self.assertEqual(record['total'], 146)
+            self.assertTrue(record['mismatch'])
+            self.assertIn('table-danger', html)
+            lines = {l['bucket']: l['quantity']
+                for l in Report._get_export_lines([record], parameters)
+                if l['bucket'] in {'final_stock', 'difference'}}
+            self.assertEqual(lines, {
+                    'final_stock': 156,
+                    'difference': 10,
+                    })
+
+    @with_transaction()
+    def test_several_warehouses(self):
+        'Test moves between warehouses classified for each warehouse'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        warehouse = storage.warehouse
+        input_, output, other_storage = Location.create([{
+                    'name': 'Input 2',
+                    'type': 'storage',
+                    }, {
+                    'name': 'Output 2',
+                    'type': 'storage',
+                    }, {
+                    'name': 'Storage 2',
+                    'type': 'storage',
+                    }])
+        other_warehouse, = Location.create([{
+                    'name': 'Warehouse 2',
+                    'type': 'warehouse',
+                    'input_location': input_.id,
+                    'output_location': output.id,
+                    'storage_location': other_storage.id,
+                    }])
+
+        company = create_company()
+        with set_company(company):
+            product = self.create_product()
+            self.create_moves(product, [
+                    (10, supplier, storage),
+                    (4, storage, other_storage),
+                    ])
+            records, parameters = Report.prepare({
+                    'warehouses': [warehouse.id, other_warehouse.id],
+                    'model': 'product.product',
+                    'ids': [product.id],
+                    'totals_only': True,
+                    })
+            record, other_record = records
+            self.assertEqual(record['warehouse'].raw, warehouse)
+            self.assertEqual(record['supplier_incommings_total'], 10)
+            self.assertEqual(record['out_to_total'], -4)
+            self.assertEqual(record['in_to_total'], 0)
+            self.assertEqual(record['total'], 6)
+            self.assertEqual(other_record['warehouse'].raw, other_warehouse)
+            self.assertEqual(other_record['supplier_incommings_total'], 0)
+            self.assertEqual(other_record['in_to_total'], 4)
+            self.assertEqual(other_record['out_to_total'], 0)
+            self.assertEqual(other_record['total'], 4)
+
+    @with_transaction()
+    def test_internal_transfers(self):
+        'Test moves inside the warehouse only classified when requested'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        output = storage.warehouse.output_location
+
+        company = create_company()
+        with set_company(company):
+            product = self.create_product()
+            self.create_moves(product, [
+                    (10, supplier, storage),
+                    (4, storage, output),
+                    ])
+            data = {
+                'warehouses': [storage.warehouse.id],
+                'model': 'product.product',
+                'ids': [product.id],
+                'totals_only': True,
+                }
+            records, parameters = Report.prepare(data)
+            record, = records
+            self.assertNotIn('internal_transfers', parameters['buckets'])
+            self.assertEqual(record['internal_transfers_total'], 0)
+            self.assertEqual(record['out_to_total'], 0)
+            self.assertEqual(record['total'], 10)
+
+            data['optional_buckets'] = ['internal_transfers']
+            records, parameters = Report.prepare(data)
+            record, = records
+            self.assertIn('internal_transfers', parameters['buckets'])
+            self.assertEqual(record['internal_transfers_total'], 4)
+            self.assertEqual(record['out_to_total'], 0)
+            self.assertEqual(record['total'], 10)
+
+    @with_transaction()
+    def test_extension_bucket(self):
+        'Test moves classified in a bucket registered by another module'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        drop, = Location.create([{
+                    'name': 'Drop',
+                    'type': 'drop',
+                    }])
+        registry = Report._get_bucket_registry
+
+        def get_bucket_registry():
+            # The moves to a drop location do not cross the warehouse
+            return registry() + [
+                Bucket('drop_ins', 'Drop In', 'supplier', 'drop', 0,
+                    Report._draw_table),
+                ]
+
+        company = create_company()
+        with set_company(company):
+            product = self.create_product()
+            self.create_moves(product, [
+                    (10, supplier, storage),
+                    (4, supplier, drop),
+                    ])
+            with patch.object(Report, '_get_bucket_registry',
+                    side_effect=get_bucket_registry):
+                records, parameters = Report.prepare({
+                        'warehouses': [storage.warehouse.id],
+                        'model': 'product.product',
+                        'ids': [product.id],
+                        'totals_only': True,
+                        })
+                record, = records
+            self.assertIn('drop_ins', parameters['buckets'])
+            self.assertEqual(record['drop_ins_total'], 4)
+            self.assertEqual(record['supplier_incommings_total'], 10)
+            self.assertEqual(record['total'], 10)
+
+    @with_transaction()
+    def test_background(self):
+        'Test report generated in a background task'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Execution = pool.get('stock.move.location.report.execution')
+        Report = pool.get('stock.move.location.report', type='report')
+        PrintStockMoveLocation = pool.get('stock.print_stock_move_location', type='wizard')
+
+        def update(execution_id, values):
+            Execution.write([Execution(execution_id)], values)
+
+        company = create_company()
+        with set_company(company):
+            product, data = self.create_supplier_moves()
+            session_id, _, _ = PrintStockMoveLocation.create()
+            print_stock_move_location = PrintStockMoveLocation(session_id)
+            start = print_stock_move_location.start
+            start.warehouses = Location.browse(data['warehouses'])
+            start.from_date = None
+            start.to_date = None
+            start.totals_only = True
+            start.link_details = False
+            start.by_lot = False
+            start.period = None
+            start.reconcile = False
+            start.internal_transfers = False
+            start.output_format = 'jsonl'
+            start.background = True
+            with Transaction().set_context(active_ids=[product.id],
+                    active_model='product.product'):
+                self.assertEqual(
+                    print_stock_move_location.transition_run(), 'end')
+            execution, = Execution.search([])
+            self.assertEqual(execution.state, 'queued')
+            self.assertEqual(list(execution.data['ids']), [product.id])
+
+            with patch.object(Execution, '_update', side_effect=update), \
+                    patch.object(Execution, '_notify') as notify:
+                Execution.generate([execution])
+            execution = Execution(execution.id)
+            self.assertEqual(execution.state, 'done')
+            self.assertEqual(execution.progress, 1)
+            self.assertTrue(execution.report_name.endswith('.jsonl'))
+            self.assertIn(b'supplier_incommings', execution.report)
+            notify.assert_called_once()
+
+            failed, = Execution.create([{'data': execution.data}])
+            with patch.object(Execution, '_update', side_effect=update), \
+                    patch.object(Report, 'execute', side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    Execution.generate([failed])
+            self.assertEqual(Execution(failed.id).state, 'failed')
+
+    @with_transaction()
+    def test_workers(self):
+        'Test report chunks computed by several workers'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+
+        company = create_company()
+        with set_company(company):
+            products = [self.create_product() for _ in range(4)]
+            for quantity, product in enumerate(products, 1):
+                self.create_moves(product, [(quantity, supplier, storage)])
+            data = {
+                'warehouses': [storage.warehouse.id],
+                'model': 'product.product',
+                'ids': [p.id for p in products],
+                }
+
+            def totals(records):
+                return [(r['product'].raw, r['supplier_incommings_total'],
+                        len(r['supplier_incommings']), r['total'])
+                    for r in records]
+
+            with patch.object(Report, '_chunk_size', return_value=1):
+                records, parameters = Report.prepare(data)
+                serial = totals(records)
+                self.assertEqual(serial, [(p, q, 1, q)
+                        for q, p in enumerate(products, 1)])
+
+                Report._prepare_cache.clear()
+                executor = SerialExecutor()
+                with patch.object(Report, '_workers', return_value=2), \
+                        patch.object(Report, '_executor',
+                            return_value=executor), \
+                        patch.object(Report, '_worker_transaction',
+                            return_value=nullcontext()):
+                    records, parameters = Report.prepare(data)
+                    first = next(records)
+                    # Only the chunks of the workers are computed ahead
+                    self.assertEqual(executor.submitted, 3)
+                    self.assertEqual(totals([first] + list(records)), serial)
+                self.assertEqual(executor.submitted, 4)
+
+    @with_transaction()
+    def test_lot_breakdown(self):
+        'Test report of products broken down by lot'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Lot = pool.get('stock.lot')
+        Date = pool.get('ir.date')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        today = Date.today()
+
+        company = create_company()
+        with set_company(company):
+            product = self.create_product()
+            lot_b, lot_a = Lot.create([{
+                        'number': 'B',
+                        'product': product.id,
+                        }, {
+                        'number': 'A',
+                        'product': product.id,
+                        }])
+            self.create_moves(product, [(5, supplier, storage)],
+                lot=lot_a.id, effective_date=today - timedelta(days=10))
+            self.create_moves(product, [(3, supplier, storage)],
+                lot=lot_a.id, effective_date=today)
+            self.create_moves(product, [(7, supplier, storage)],
+                lot=lot_b.id, effective_date=today)
+            self.create_moves(product, [(2, supplier, storage)],
+                effective_date=today)
+
+            records, parameters = Report.prepare({
+                    'warehouses': [storage.warehouse.id],
+                    'from_date': today - timedelta(days=5),
+                    'to_date': today,
+                    'model': 'product.product',
+                    'ids': [product.id],
+                    'by_lot': True,
+                    'link_details': True,
+                    })
+            records = list(records)
+            self.assertTrue(parameters['by_lot'])
+            self.assertEqual(
+                [(r['product'].raw, r['lot'].raw, r['initial_stock'],
+                        r['supplier_incommings_total'], r['total'])
+                    for r in records],
+                [(product, lot_a, 5, 3, 8), (product, lot_b, 0, 7, 7),
+                    (product, None, 0, 2, 2)])
+
+            domain = Report._get_detail_domain(
+                records[-1], 'supplier_incommings', parameters)
+            self.assertIn(('lot', '=', None), domain)
+            move, = Move.search(domain)
+            self.assertEqual(move.quantity, 2)
+            move, = Move.search(Report._get_detail_domain(
+                    records[0], 'supplier_incommings', parameters))
+            self.assertEqual(move.lot, lot_a)
+
+    @with_transaction()
+    def test_ledger(self):
+        'Test report totals read from the ledger'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Ledger = pool.get('stock.move.location.ledger')
+        PrintStockMoveLocationReport = pool.get('stock.move.location.report', type='report')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Move',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+
+        company = create_company()
+        currency = company.currency
+        with set_company(company):
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': from_location.id,
+                        'to_location': to_location.id,
+                        'company': company.id,
+                        'unit_price': Decimal('1'),
+                        'currency': currency.id,
+                        } for quantity, from_location, to_location in [
+                        (10, supplier, storage),
+                        (100, supplier, storage),
+                        (4, storage, customer),
+                        ]])
+            Move.do(moves)
+            Ledger.rebuild()
+
+            lines = Ledger.search([])
+            self.assertEqual(
+                sorted((l.bucket, l.quantity) for l in lines),
+                [('customer_outgoings', 4), ('supplier_incommings', 110)])
+
+            data = {
+                'warehouse': storage.warehouse.id,
+                'model': 'product.product',
+                'ids': [product.id],
+                'totals_only': True,
+                }
+            with patch.object(Ledger, 'configured', return_value=True):
+                self.assertTrue(Ledger.enabled())
+                records, parameters = PrintStockMoveLocationReport.prepare(
+                    data)
+                record, = records
+                self.assertEqual(record['supplier_incommings_total'], 110)
+                self.assertEqual(record['customer_outgoings_total'], -4)
+                self.assertEqual(record['total'], 106)
+
+                # The moves of the same day and bucket are added to the line
+                self.create_moves(product, [(5, supplier, storage)])
+                line, = Ledger.search([
+                        ('bucket', '=', 'supplier_incommings'),
+                        ])
+                self.assertEqual(line.quantity, 115)
+
+                # The ledger must be rebuilt when the tree changes
+                location, = Location.create([{
+                            'name': 'Shelf',
+                            'type': 'storage',
+                            }])
+                Location.write([location], {'parent': storage.id})
+                self.assertFalse(Ledger.enabled())
+                Ledger.rebuild()
+                self.assertTrue(Ledger.enabled())
+
+    @with_transaction()
+    def test_checkpoint_history(self):
+        'Test report from checkpoints reading only the moves after them'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Date = pool.get('ir.date')
+        Checkpoint = pool.get('stock.move.location.checkpoint')
+        Report = pool.get('stock.move.location.report', type='report')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        warehouse = storage.warehouse
+        today = Date.today()
+        # The lines of a checkpoint are stored by the same run
+        stamp = datetime.now() + timedelta(days=1)
+
+        def phases(history):
+            "Return the quantities phase of a product with history moves"
+            product = self.create_product()
+            self.create_moves(product, [(1, supplier, storage)] * history,
+                effective_date=today - timedelta(days=10))
+            self.create_moves(product, [(1, supplier, storage)],
+                effective_date=today)
+            Checkpoint.create([{
+                        'company': company.id,
+                        'warehouse': warehouse.id,
+                        'product': product.id,
+                        'date': today - timedelta(days=1),
+                        'stamp': stamp,
+                        'bucket': name,
+                        'quantity': history
+                        if name == 'supplier_incommings' else 0,
+                        } for name in Report._get_bucket_names()])
+            with Transaction().set_context(
+                    stock_move_location_diagnostics=True):
+                records, parameters = Report.prepare({
+                        'warehouses': [warehouse.id],
+                        'to_date': today,
+                        'model': 'product.product',
+                        'ids': [product.id],
+                        'totals_only': True,
+                        })
+                record, = records
+            self.assertEqual(record['supplier_incommings_total'],
+                history + 1)
+            diagnostics = parameters['diagnostics'].as_dict()
+            self.assertNotIn('watermark', diagnostics['phases'])
+            quantities = diagnostics['phases']['quantities']
+            return quantities['statements'], quantities['rows']
+
+        company = create_company()
+        with set_company(company):
+            with patch.object(Checkpoint, 'enabled', return_value=True), \
+                    patch.object(Checkpoint, 'store'):
+                self.assertEqual(phases(2), phases(20))
+
+    @with_transaction()
+    def test_checkpoint(self):
+        'Test report totals merged from the checkpoints'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Date = pool.get('ir.date')
+        Checkpoint = pool.get('stock.move.location.checkpoint')
+        PrintStockMoveLocationReport = pool.get('stock.move.location.report', type='report')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Test Move',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+
+        company = create_company()
+        currency = company.currency
+        today = Date.today()
+        yesterday = today - timedelta(days=1)
+        with set_company(company):
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'company': company.id,
+                        'unit_price': Decimal('1'),
+                        'currency': currency.id,
+                        'effective_date': yesterday,
+                        } for quantity in [10, 100]])
+            Move.do(moves)
+
+            warehouse = storage.warehouse
+            data = {
+                'warehouse': warehouse.id,
+                'to_date': yesterday,
+                'model': 'product.product',
+                'ids': [product.id],
+                'totals_only': True,
+                }
+            with patch.object(Checkpoint, 'enabled', return_value=True), \
+                    patch.object(Checkpoint, 'store') as store:
+                records, parameters = PrintStockMoveLocationReport.prepare(
+                    data)
+                record, = records
+                self.assertEqual(record['supplier_incommings_total'], 110)
+                (_, _, _, date, _, totals), _ = store.call_args
+                self.assertEqual(date, yesterday)
+                self.assertEqual(
+                    totals[product.id, None][
+                        warehouse.id, 'supplier_incommings'],
+                    110)
+
+                # The moves of today can still be done
+                store.reset_mock()
+                data['to_date'] = today
+                PrintStockMoveLocationReport._prepare_cache.clear()
+                PrintStockMoveLocationReport.prepare(data)
+                store.assert_not_called()
+
+                # Only the moves after the checkpoint are added
+                stamp = datetime.now() + timedelta(days=1)
+                Checkpoint.create([{
+                            'company': company.id,
+                            'warehouse': warehouse.id,
+                            'product': product.id,
+                            'date': yesterday - timedelta(days=1),
+                            'stamp': stamp,
+                            'bucket': name,
+                            'quantity': 1000 if name == 'supplier_incommings'
+                            else 0,
+                            } for name in PrintStockMoveLocationReport
+                        ._get_bucket_names()])
+                PrintStockMoveLocationReport._prepare_cache.clear()
+                records, parameters = PrintStockMoveLocationReport.prepare(
+                    data)
+                record, = records
+                self.assertEqual(record['supplier_incommings_total'], 1110)
 
 
 del ModuleTestCase